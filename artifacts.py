@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import os , csv
+import numpy as np
+
+from manifest import atomicOutput
+
+
+## example files written by preprocessing_bert.py, read by bert.py and map.py
+# columns: query_name , query_content , the choices ( answer for training rows,
+# top1000 for test rows ) and label
+# csv     : comma separated text, choices joined by spaces, fields quoted when needed
+# arrow   : Arrow IPC stream, choices as list<string>, memory-mapped when read
+# parquet : Parquet, same typed columns as arrow
+# pyarrow ships with datasets, it is only imported for the arrow and parquet formats
+
+FORMATS = { "csv" : ".csv" , "arrow" : ".arrow" , "parquet" : ".parquet" }
+
+
+def exampleFile( dic_save , name , output_format="csv" ):
+    return dic_save + name + FORMATS[ output_format ]
+
+
+def findExampleFile( dic_save , name ):
+    # the columnar file when preprocessing wrote one, else the csv
+    for output_format in ( "arrow" , "parquet" , "csv" ):
+        if os.path.exists( exampleFile( dic_save , name , output_format ) ):
+            return exampleFile( dic_save , name , output_format )
+    return exampleFile( dic_save , name )
+
+
+def choiceList( choices ):
+    # the choices of a row as loaded from an example file of any format ( see above ), as a list
+    return choices.split() if isinstance( choices , str ) else choices
+
+
+def _schema( choice_column ):
+    import pyarrow as pa
+    return pa.schema( [
+        ( "query_name" , pa.string() ) ,
+        ( "query_content" , pa.string() ) ,
+        ( choice_column , pa.list_( pa.string() ) ) ,
+        ( "label" , pa.int64() ) ,
+    ] )
+
+
+class ExampleWriter:
+
+    def __init__( self , path , choice_column="answer" , batch_size=10000 ):
+        self.path = path
+        self.choice_column = choice_column
+        self.batch_size = batch_size
+        self.output_format = os.path.splitext( path )[1][1:]
+        self._rows = []
+        if self.output_format == "csv":
+            self._file = open( path , "w" , newline='' )
+            self._csv = csv.writer( self._file , lineterminator="\n" )
+            self._csv.writerow( [ "query_name" , "query_content" , choice_column , "label" ] )
+        elif self.output_format == "arrow":
+            import pyarrow as pa
+            import pyarrow.ipc as ipc
+            self._file = pa.OSFile( path , "wb" )
+            self._writer = ipc.new_stream( self._file , _schema( choice_column ) )
+        elif self.output_format == "parquet":
+            import pyarrow.parquet as pq
+            self._file = None
+            self._writer = pq.ParquetWriter( path , _schema( choice_column ) )
+        else:
+            raise ValueError( "unknown example format: {}".format( path ) )
+
+    def write( self , query_name , query_content , choices , label ):
+        if self.output_format == "csv":
+            self._csv.writerow( [ query_name , query_content , " ".join( choices ) , label ] )
+            return
+        self._rows.append( ( query_name , query_content , list( choices ) , int( label ) ) )
+        if len( self._rows ) >= self.batch_size:
+            self._flush()
+
+    def _flush( self ):
+        import pyarrow as pa
+        if self._rows:
+            columns = [ list( x ) for x in zip( *self._rows ) ]
+            self._writer.write_batch( pa.record_batch( columns , schema=_schema( self.choice_column ) ) )
+            self._rows = []
+
+    def close( self ):
+        if self.output_format != "csv":
+            self._flush()
+            self._writer.close()
+        if self._file is not None:
+            self._file.close()
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self , *exc ):
+        self.close()
+
+
+def writeTopRows( path , queries_dict , que_top_dict , top_k=None , group_size=4 , seed=0 , choice_column="top1000" ):
+    # the first-stage head of every query's list, shuffled into rows of group_size choices
+    # top_k is rounded up to whole rows, only a list shorter than that ends on a smaller row
+    from sampling import queryRng
+    with ExampleWriter( path , choice_column=choice_column ) as writefile:
+        for query_name , d_v in que_top_dict.items():
+            docs = list( d_v.keys() )
+            if top_k is not None:
+                docs = docs[ : -( -top_k // group_size ) * group_size ]
+            if group_size > 1:
+                docs = [ docs[ i ] for i in queryRng( seed , query_name , 2 ).permutation( len( docs ) ) ]
+            for i in range( 0 , len( docs ) , group_size ):
+                writefile.write( query_name , queries_dict[ query_name ] , docs[ i : i + group_size ] , 0 )
+
+
+def _readTable( path ):
+    import pyarrow as pa
+    import pyarrow.ipc as ipc
+    import pyarrow.parquet as pq
+    if path.endswith( ".arrow" ):
+        return ipc.open_stream( pa.memory_map( path ) ).read_all()
+    return pq.read_table( path , memory_map=True )
+
+
+def readChoiceRows( path ):
+    # ( query_name , [ doc_name , ... ] ) of every row, in file order
+    if path.endswith( ".csv" ):
+        with open( path , newline='' ) as csvfile:
+            spamreader = csv.reader( csvfile , delimiter=',' )
+            next( spamreader )
+            return [ ( row[0] , row[2].split() ) for row in spamreader ]
+    table = _readTable( path )
+    return list( zip( table.column( 0 ).to_pylist() , table.column( 2 ).to_pylist() ) )
+
+
+def loadExamples( data_files ):
+    # { split : path } to a DatasetDict, arrow files are memory-mapped as they are
+    from datasets import Dataset, DatasetDict, load_dataset
+    extension = os.path.splitext( list( data_files.values() )[0] )[1][1:]
+    if extension == "arrow":
+        return DatasetDict( { split : Dataset.from_file( path ) for split , path in data_files.items() } )
+    return load_dataset( extension , data_files=data_files )
+
+
+## BERT logits of prediction rows, written by bert.py and predict.py, read by map.py
+# <name>.npy      : ( rows , choices ) float32 logits, memory-mapped when read
+# <name>.rows.npz : the rows they belong to; names holds every query and document name once, ids is
+#                   ( rows , 1 + choices ) int32 indices into names, the query first, -1 past a shorter row's documents
+
+
+def logitsSidecar( path ):
+    return os.path.splitext( path )[0] + ".rows.npz"
+
+
+def writeLogits( path , rows , logits ):
+    # rows : ( query_name , [ doc_name , ... ] ) of every row of logits
+    logits = np.asarray( logits , dtype=np.float32 ).reshape( len( rows ) , -1 )
+    vocab = {}
+    ids = np.full( ( len( rows ) , 1 + logits.shape[1] ) , -1 , dtype=np.int32 )
+    for i , ( query_name , doc_list ) in enumerate( rows ):
+        ids[ i , : 1 + len( doc_list ) ] = [ vocab.setdefault( name , len( vocab ) ) for name in [ query_name , *doc_list ] ]
+    with atomicOutput( logitsSidecar( path ) ) as tmp:
+        np.savez( tmp , names=np.array( list( vocab ) , dtype=str ) , ids=ids )
+    with atomicOutput( path ) as tmp:
+        np.save( tmp , logits )
+
+
+def readLogits( path ):
+    # ( rows , logits ), the logits memory-mapped: only what is indexed is read
+    sidecar = np.load( logitsSidecar( path ) )
+    # names looked up in one take, -1 lands on the trailing None
+    names = np.array( sidecar[ "names" ].tolist() + [ None ] , dtype=object )
+    rows = [ ( row[0] , row[ 1 : ] if row[ -1 ] is not None else [ x for x in row[ 1 : ] if x is not None ] ) for row in names[ sidecar[ "ids" ] ].tolist() ]
+    return rows , np.load( path , mmap_mode="r" )
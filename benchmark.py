@@ -0,0 +1,414 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import os , sys , csv , json , time , pickle , random , shutil , argparse , platform , resource , subprocess
+from importlib.metadata import version
+import numpy as np
+
+from manifest import Manifest
+
+
+## benchmark of the pipeline stages on a synthetic corpus
+# python benchmark.py --workdir bench/ builds, inside workdir, a data/ shaped like the homework csvs
+# ( --docs , --doc_words , --queries , --top_k ) and a tiny random-init BERT whose vocabulary is the corpus's,
+# then runs every stage in a fresh process of its own and reports seconds, throughput and peak RSS
+# a stage's setup ( stores opened , model loaded ) is not timed, its peak RSS is the whole process's
+# --save_baseline stores the report, --baseline compares a run with it: a stage whose throughput drops or whose
+# peak RSS grows by more than --tolerance is a regression, and the exit status is 1
+# nothing is downloaded, everything runs on the CPU
+
+STAGES = ( "preprocessing" , "ingestion" , "sampling" , "tokenization" , "collation" , "predict" , "alignment" , "alpha_sweep" , "map" )
+# the corpus and model settings a baseline is only comparable under
+CONFIG = ( "docs" , "doc_words" , "queries" , "top_k" , "vocab_size" , "hidden_size" , "layers" , "max_seq_length" , "batch_size" , "group_size" , "num_workers" , "threads" , "seed" )
+SPECIAL_TOKENS = [ "[PAD]" , "[UNK]" , "[CLS]" , "[SEP]" , "[MASK]" ]
+ALPHAS = np.arange( 0.01 , 5.01 , 0.01 )
+
+
+def pickleOpen( filename ):
+    file_to_read = open( filename , "rb" )
+    p = pickle.load( file_to_read )
+    return p
+
+
+def peakRss():
+    # MB; on Linux VmHWM of this process, ru_maxrss would keep the peak of the process that started it across exec
+    if os.path.exists( "/proc/self/status" ):
+        with open( "/proc/self/status" ) as readfile:
+            for line in readfile:
+                if line.startswith( "VmHWM:" ):
+                    return int( line.split()[1] ) / 1024.0
+    # ru_maxrss is in bytes on macOS
+    peak = resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss
+    return peak / ( 1024.0 * 1024.0 if sys.platform == "darwin" else 1024.0 )
+
+
+## synthetic corpus
+# words are "w0" , "w1" , ... drawn with Zipf frequencies; every query has a first-stage list of top_k distinct
+# documents with descending scores, the training queries 1 to 5 positives among the first 30 of it
+
+
+def writeCorpus( args , dic_sources ):
+    rng = random.Random( args.seed )
+    vocabulary = [ "w{}".format( i ) for i in range( args.vocab_size ) ]
+    weights = list( np.cumsum( 1.0 / np.arange( 1 , args.vocab_size + 1 ) ) )
+    doc_names = [ "FBIS{}".format( i ) for i in range( args.docs ) ]
+
+    def words( n ):
+        return " ".join( rng.choices( vocabulary , cum_weights=weights , k=n ) )
+
+    with open( dic_sources + "documents.csv" , "w" , newline="" ) as writefile:
+        spamwriter = csv.writer( writefile )
+        spamwriter.writerow( [ "doc_id" , "doc_text" ] )
+        for doc_name in doc_names:
+            spamwriter.writerow( [ doc_name , words( rng.randint( args.doc_words // 2 , args.doc_words * 3 // 2 ) ) ] )
+    for filename , first_id , with_positives in ( ( "train_queries.csv" , 0 , True ) , ( "test_queries.csv" , args.queries , False ) ):
+        with open( dic_sources + filename , "w" , newline="" ) as writefile:
+            spamwriter = csv.writer( writefile )
+            spamwriter.writerow( [ "query_id" , "query_text" ] + ( [ "pos_doc_ids" ] if with_positives else [] ) + [ "bm25_top1000" , "bm25_top1000_scores" ] )
+            for i in range( args.queries ):
+                top_docs = rng.sample( doc_names , min( args.top_k , args.docs ) )
+                scores = sorted( ( rng.uniform( 5.0 , 30.0 ) for _ in top_docs ) , reverse=True )
+                row = [ str( 100 + first_id + i ) , words( rng.randint( 2 , 6 ) ) ]
+                if with_positives:
+                    row.append( " ".join( rng.sample( top_docs[ :30 ] , rng.randint( 1 , min( 5 , len( top_docs ) ) ) ) ) )
+                spamwriter.writerow( row + [ " ".join( top_docs ) , " ".join( "{:.3f}".format( score ) for score in scores ) ] )
+    return vocabulary
+
+
+def writeModel( args , model_dir , vocabulary ):
+    # random weights: the timings do not depend on what the model learned
+    import torch
+    from transformers import BertConfig, BertForMultipleChoice, BertTokenizerFast
+    os.makedirs( model_dir , exist_ok=True )
+    with open( os.path.join( model_dir , "vocab.txt" ) , "w" ) as writefile:
+        writefile.write( "\n".join( SPECIAL_TOKENS + vocabulary ) + "\n" )
+    tokenizer = BertTokenizerFast( vocab_file=os.path.join( model_dir , "vocab.txt" ) , model_max_length=args.max_seq_length )
+    tokenizer.save_pretrained( model_dir )
+    torch.manual_seed( args.seed )
+    config = BertConfig( vocab_size=len( tokenizer ) , hidden_size=args.hidden_size , num_hidden_layers=args.layers , num_attention_heads=2 ,
+                         intermediate_size=4 * args.hidden_size , max_position_embeddings=args.max_seq_length )
+    BertForMultipleChoice( config ).save_pretrained( model_dir )
+
+
+## stages
+# each returns run, called --repeat times and timed, and the unit of the items run returns it processed
+# they run with workdir as the current directory, where the scripts look for data/ and save/
+
+
+def stagePreprocessing( args ):
+    # the whole script, every manifest stage rebuilt
+    import runpy
+    script = os.path.join( os.path.dirname( os.path.abspath( __file__ ) ) , "preprocessing_bert.py" )
+
+    def run():
+        sys.argv = [ script , "--force" , "--num_workers" , str( args.num_workers ) , "--group_size" , str( args.group_size ) ]
+        runpy.run_path( script , run_name="__main__" )
+        return args.docs
+    return run , "docs"
+
+
+def stageIngestion( args ):
+    # documents.csv to a document store
+    from docstore import DocStoreWriter
+    from preprocessing_bert import readDocuments
+
+    def run():
+        n = 0
+        with DocStoreWriter( "save/benchmark_docs_store" ) as docs_store:
+            for doc_name , text in readDocuments( "data/documents.csv" , num_workers=args.num_workers ):
+                docs_store.add( doc_name , text )
+                n += 1
+        shutil.rmtree( "save/benchmark_docs_store" )
+        return n
+    return run , "docs"
+
+
+def stageSampling( args ):
+    # training rows of every query, as the train stage of preprocessing_bert.py draws them
+    from preprocessing_bert import readQueries
+    from sampling import sampleQueries
+    alpha_set = set( pickleOpen( "save/alpha_querys_docs_list.pkl" ) )
+    mining = { "strategy" : "half" , "band" : ( 10 , 100 ) , "replace" : True }
+    tasks = [ ( query_name , query_content , positives , top_docs , query_name in alpha_set , args.seed , args.group_size , mining , None )
+              for query_name , query_content , positives , top_docs , _ in readQueries( "data/train_queries.csv" ) ]
+
+    def run():
+        return sum( len( rows ) + len( alpha_rows ) for rows , alpha_rows in sampleQueries( tasks , args.num_workers ) )
+    return run , "rows"
+
+
+def encodedRows( args , tokenizer , name , queries_dict ):
+    # rows of an example file with their features, as bert.py encodes them, from the token cache
+    from artifacts import findExampleFile, readChoiceRows
+    from docstore import openDocStore
+    from tokencache import buildTokenCache, encodeChoices, openTokenCache, tokenCachePath
+    path = tokenCachePath( "save/" , tokenizer , args.max_seq_length )
+    if not os.path.exists( path ):
+        buildTokenCache( path , openDocStore( "save/docs_store" ) , tokenizer , args.max_seq_length )
+    rows = readChoiceRows( findExampleFile( "save/" , name ) )
+    encoded = encodeChoices( tokenizer , openTokenCache( path ) , [ queries_dict[ query_name ] for query_name , _ in rows ] , [ doc_list for _ , doc_list in rows ] , args.max_seq_length )
+    features = [ dict( { k : v[ i ] for k , v in encoded.items() } , label=0 ) for i in range( len( rows ) ) ]
+    return rows , features
+
+
+def stageTokenization( args ):
+    # the token cache of every document, then the test rows encoded from it
+    from transformers import AutoTokenizer
+    from artifacts import findExampleFile, readChoiceRows
+    from docstore import openDocStore
+    import tokencache
+    from tokencache import buildTokenCache, encodeChoices, openTokenCache
+    tokenizer = AutoTokenizer.from_pretrained( "model" )
+    docs_store = openDocStore( "save/docs_store" )
+    queries_dict = pickleOpen( "save/test_queries_dict.pkl" )
+    rows = readChoiceRows( findExampleFile( "save/" , "test" ) )
+
+    def run():
+        # query ids are kept per process, every repeat tokenizes the queries again
+        tokencache._query_ids.clear()
+        path = buildTokenCache( "save/token_cache/benchmark" , docs_store , tokenizer , args.max_seq_length )
+        encodeChoices( tokenizer , openTokenCache( path ) , [ queries_dict[ query_name ] for query_name , _ in rows ] , [ doc_list for _ , doc_list in rows ] , args.max_seq_length )
+        shutil.rmtree( path )
+        return len( rows )
+    return run , "rows"
+
+
+def stageCollation( args ):
+    from transformers import AutoTokenizer
+    from bert import DataCollatorForMultipleChoice
+    tokenizer = AutoTokenizer.from_pretrained( "model" )
+    collator = DataCollatorForMultipleChoice( tokenizer )
+    _ , features = encodedRows( args , tokenizer , "test" , pickleOpen( "save/test_queries_dict.pkl" ) )
+
+    def run():
+        # the collator pops the labels, every repeat gets its own copies
+        for start in range( 0 , len( features ) , args.batch_size ):
+            collator( [ dict( feature ) for feature in features[ start : start + args.batch_size ] ] )
+        return len( features )
+    return run , "rows"
+
+
+def stagePredict( args ):
+    # logits of the alpha and test rows, written where bert.py writes them for the map stages
+    import torch
+    from transformers import AutoModelForMultipleChoice, AutoTokenizer
+    from artifacts import writeLogits
+    from bert import DataCollatorForMultipleChoice
+    if args.threads is not None:
+        torch.set_num_threads( args.threads )
+    tokenizer = AutoTokenizer.from_pretrained( "model" )
+    model = AutoModelForMultipleChoice.from_pretrained( "model" ).eval()
+    collator = DataCollatorForMultipleChoice( tokenizer )
+    splits = [ ( "save/trainer_alpha_result.npy" , *encodedRows( args , tokenizer , "train_for_alpha_train" , pickleOpen( "save/train_queries_dict.pkl" ) ) ) ,
+               ( "save/trainer_test_result.npy" , *encodedRows( args , tokenizer , "test" , pickleOpen( "save/test_queries_dict.pkl" ) ) ) ]
+    batches = [ [ collator( features[ start : start + args.batch_size ] ) for start in range( 0 , len( features ) , args.batch_size ) ] for _ , _ , features in splits ]
+
+    def run():
+        for ( path , rows , _ ) , split_batches in zip( splits , batches ):
+            logits = np.zeros( ( len( rows ) , max( len( doc_list ) for _ , doc_list in rows ) ) , dtype=np.float32 )
+            start = 0
+            with torch.no_grad():
+                for batch in split_batches:
+                    output = model( **{ k : v for k , v in batch.items() if k != "labels" } ).logits.numpy()
+                    logits[ start : start + len( output ) , : output.shape[1] ] = output
+                    start += len( output )
+            writeLogits( path , rows , logits )
+        return sum( len( rows ) for _ , rows , _ in splits )
+    return run , "rows"
+
+
+def alphaMatrix():
+    from artifacts import readLogits
+    from fusion import alignScores
+    rows , logits = readLogits( "save/trainer_alpha_result.npy" )
+    return alignScores( rows , logits , pickleOpen( "save/train_que_top_dict.pkl" ) , set( pickleOpen( "save/alpha_querys_docs_list.pkl" ) ) )
+
+
+def stageAlignment( args ):
+    # logits of the alpha and test rows to query by candidate matrices, as map.py reads them
+    from artifacts import readLogits
+    from fusion import alignScores
+    alpha_list = set( pickleOpen( "save/alpha_querys_docs_list.pkl" ) )
+    train_que_top_dict = pickleOpen( "save/train_que_top_dict.pkl" )
+    test_que_top_dict = pickleOpen( "save/test_que_top_dict.pkl" )
+
+    def run():
+        alpha_rows , alpha_logits = readLogits( "save/trainer_alpha_result.npy" )
+        test_rows , test_logits = readLogits( "save/trainer_test_result.npy" )
+        alignScores( alpha_rows , alpha_logits , train_que_top_dict , alpha_list )
+        alignScores( test_rows , test_logits , test_que_top_dict )
+        return sum( len( doc_list ) for _ , doc_list in alpha_rows + test_rows )
+    return run , "pairs"
+
+
+def stageAlphaSweep( args ):
+    # the alpha grid of map.py
+    from fusion import sweepAlpha
+    alpha_matrix = alphaMatrix()
+    relevant , n_relevant = alpha_matrix.relevant( pickleOpen( "save/train_que_pos_dict.pkl" ) )
+
+    def run():
+        sweepAlpha( alpha_matrix , ALPHAS , relevant , n_relevant )
+        return len( ALPHAS )
+    return run , "alphas"
+
+
+def stageMap( args ):
+    # MAP of the alpha queries at the best alpha, then the reranked test queries written as map.py writes them
+    from artifacts import readLogits
+    from evaluation import meanAveragePrecision
+    from fusion import alignScores, sweepAlpha, writeRanking
+    alpha_matrix = alphaMatrix()
+    relevant , n_relevant = alpha_matrix.relevant( pickleOpen( "save/train_que_pos_dict.pkl" ) )
+    bestalpha = float( ALPHAS[ np.argmax( sweepAlpha( alpha_matrix , ALPHAS , relevant , n_relevant ) ) ] )
+    que_top_dict = pickleOpen( "save/test_que_top_dict.pkl" )
+    test_matrix = alignScores( *readLogits( "save/trainer_test_result.npy" ) , que_top_dict )
+
+    def run():
+        scores = alpha_matrix.fuse( bestalpha )
+        meanAveragePrecision( np.take_along_axis( relevant , alpha_matrix.ranking( scores ) , axis=-1 ) , n_relevant )
+        scores = test_matrix.fuse( bestalpha )
+        writeRanking( "save/benchmark_rerank.csv" , test_matrix , scores , que_top_dict )
+        return len( alpha_matrix.queries ) + len( test_matrix.queries )
+    return run , "queries"
+
+
+STAGE_FUNCTIONS = { "preprocessing" : stagePreprocessing , "ingestion" : stageIngestion , "sampling" : stageSampling ,
+                    "tokenization" : stageTokenization , "collation" : stageCollation , "predict" : stagePredict ,
+                    "alignment" : stageAlignment , "alpha_sweep" : stageAlphaSweep , "map" : stageMap }
+
+
+def runStage( args ):
+    # inside the stage's own process: the best of at least --repeat timed runs, run again until --min_time
+    # seconds were spent, so that the stages of a few milliseconds are not timed once
+    run , unit = STAGE_FUNCTIONS[ args.run_stage ]( args )
+    times = []
+    while len( times ) < args.repeat or sum( times ) < args.min_time:
+        start = time.perf_counter()
+        items = run()
+        times.append( time.perf_counter() - start )
+    seconds = min( times )
+    result = { "seconds" : seconds , "runs" : len( times ) , "items" : items , "unit" : unit , "throughput" : items / max( seconds , 1e-9 ) , "peak_rss_mb" : peakRss() }
+    with open( args.result_file , "w" ) as writefile:
+        json.dump( result , writefile )
+
+
+def spawnStage( args , stage , workdir ):
+    # a fresh interpreter per stage, so its peak RSS is its own; offline and on the CPU
+    result_file = os.path.join( workdir , "save" , "benchmark-{}.json".format( stage ) )
+    command = [ sys.executable , os.path.abspath( __file__ ) , "--run_stage" , stage , "--result_file" , result_file ] + [ "--{0}={1}".format( name , getattr( args , name ) ) for name in CONFIG if getattr( args , name ) is not None ] + [ "--repeat" , str( args.repeat ) , "--min_time" , str( args.min_time ) ]
+    env = dict( os.environ , HF_HUB_OFFLINE="1" , TRANSFORMERS_OFFLINE="1" , HF_DATASETS_OFFLINE="1" , CUDA_VISIBLE_DEVICES="" , TOKENIZERS_PARALLELISM="false" ,
+                PYTHONPATH=os.pathsep.join( [ os.path.dirname( os.path.abspath( __file__ ) ) ] + ( [ os.environ[ "PYTHONPATH" ] ] if os.environ.get( "PYTHONPATH" ) else [] ) ) )
+    finished = subprocess.run( command , cwd=workdir , env=env , stdout=subprocess.PIPE , stderr=subprocess.STDOUT , text=True )
+    if finished.returncode != 0:
+        raise SystemExit( "stage {0} failed:\n{1}".format( stage , finished.stdout[ -5000: ] ) )
+    with open( result_file ) as readfile:
+        return json.load( readfile )
+
+
+def compare( report , baseline , tolerance ):
+    # ( stage , throughput change , peak RSS change , regression ) of the stages both reports have
+    if baseline[ "config" ] != report[ "config" ]:
+        print( "The baseline was measured with other settings, not compared:" )
+        for name in CONFIG:
+            if baseline[ "config" ].get( name ) != report[ "config" ].get( name ):
+                print( "  {0}: {1} in the baseline, {2} now".format( name , baseline[ "config" ].get( name ) , report[ "config" ].get( name ) ) )
+        return []
+    changes = []
+    for stage , result in report[ "stages" ].items():
+        if stage not in baseline[ "stages" ]:
+            continue
+        before = baseline[ "stages" ][ stage ]
+        speed = result[ "throughput" ] / max( before[ "throughput" ] , 1e-9 ) - 1.0
+        memory = result[ "peak_rss_mb" ] / max( before[ "peak_rss_mb" ] , 1e-9 ) - 1.0
+        changes.append( ( stage , speed , memory , speed < -tolerance or memory > tolerance ) )
+    return changes
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument( "--workdir" , default="benchmark/" , help="where the synthetic data/ , save/ and model/ go, reused while the corpus and model settings stay the same" )
+    parser.add_argument( "--stages" , nargs="+" , default=list( STAGES ) , choices=STAGES , help="stages to time, in pipeline order" )
+    parser.add_argument( "--docs" , type=int , default=2000 , help="documents of the corpus" )
+    parser.add_argument( "--doc_words" , type=int , default=300 , help="mean words of a document, lengths are uniform in [ 0.5 , 1.5 ] times it" )
+    parser.add_argument( "--queries" , type=int , default=80 , help="training queries, and as many test queries" )
+    parser.add_argument( "--top_k" , type=int , default=100 , help="first-stage list length of every query" )
+    parser.add_argument( "--vocab_size" , type=int , default=2000 , help="distinct words of the corpus, the model vocabulary" )
+    parser.add_argument( "--hidden_size" , type=int , default=64 , help="hidden size of the random BERT" )
+    parser.add_argument( "--layers" , type=int , default=2 , help="layers of the random BERT" )
+    parser.add_argument( "--max_seq_length" , type=int , default=128 , help="tokens of a ( query , document ) pair" )
+    parser.add_argument( "--batch_size" , type=int , default=32 , help="rows per forward pass and per collated batch" )
+    parser.add_argument( "--group_size" , type=int , default=4 , help="choices per row, passed to preprocessing_bert.py" )
+    parser.add_argument( "--num_workers" , type=int , default=1 , help="processes of document reading and sampling" )
+    parser.add_argument( "--threads" , type=int , default=None , help="torch threads, all cores by default" )
+    parser.add_argument( "--seed" , type=int , default=0 , help="seed of the corpus and the model weights" )
+    parser.add_argument( "--repeat" , type=int , default=3 , help="timed runs of every stage at least, the fastest is kept" )
+    parser.add_argument( "--min_time" , type=float , default=1.0 , help="seconds every stage is run for at least, in whole runs" )
+    parser.add_argument( "--output" , default=None , help="report of this run, workdir/benchmark.json by default" )
+    parser.add_argument( "--baseline" , default=None , help="report to compare with; a stage slower or larger than --tolerance allows is a regression" )
+    parser.add_argument( "--save_baseline" , action="store_true" , help="also write this run's report to --baseline" )
+    parser.add_argument( "--tolerance" , type=float , default=0.25 , help="allowed throughput drop and peak RSS growth, as a fraction of the baseline" )
+    parser.add_argument( "--run_stage" , default=None , choices=STAGES , help=argparse.SUPPRESS )
+    parser.add_argument( "--result_file" , default=None , help=argparse.SUPPRESS )
+    args = parser.parse_args()
+
+    if args.run_stage is not None:
+        runStage( args )
+        sys.exit( 0 )
+    if args.save_baseline and args.baseline is None:
+        parser.error( "--save_baseline needs --baseline" )
+
+    ## corpus and model, rebuilt only when their settings change
+    workdir = os.path.abspath( args.workdir )
+    dic_sources = os.path.join( workdir , "data" ) + "/"
+    os.makedirs( dic_sources , exist_ok=True )
+    os.makedirs( os.path.join( workdir , "save" ) , exist_ok=True )
+    manifest = Manifest( os.path.join( workdir , "benchmark_manifest.json" ) )
+    config = { name : getattr( args , name ) for name in CONFIG }
+    params = { name : config[ name ] for name in ( "docs" , "doc_words" , "queries" , "top_k" , "vocab_size" , "hidden_size" , "layers" , "max_seq_length" , "seed" ) }
+    outputs = [ dic_sources + filename for filename in ( "documents.csv" , "train_queries.csv" , "test_queries.csv" ) ] + [ os.path.join( workdir , "model" , "config.json" ) ]
+    if manifest.stale( "corpus" , [] , params , outputs ):
+        print( "*** Writing a corpus of {0} documents and {1} + {1} queries to {2} ***".format( args.docs , args.queries , dic_sources ) )
+        # the artifacts of an older corpus would be taken for fresh ones
+        shutil.rmtree( os.path.join( workdir , "save" ) )
+        os.makedirs( os.path.join( workdir , "save" ) )
+        writeModel( args , os.path.join( workdir , "model" ) , writeCorpus( args , dic_sources ) )
+        manifest.record( "corpus" , [] , params , outputs )
+
+    ## stages, each in its own process
+    stages = [ stage for stage in STAGES if stage in args.stages ]
+    if "preprocessing" not in stages and not os.path.exists( os.path.join( workdir , "save" , "manifest.json" ) ):
+        # later stages read its outputs
+        spawnStage( args , "preprocessing" , workdir )
+    if any( stage in stages for stage in ( "alignment" , "alpha_sweep" , "map" ) ) and "predict" not in stages and not os.path.exists( os.path.join( workdir , "save" , "trainer_test_result.npy" ) ):
+        spawnStage( args , "predict" , workdir )
+
+    environment = { "python" : platform.python_version() , "numpy" : version( "numpy" ) , "torch" : version( "torch" ) , "transformers" : version( "transformers" ) ,
+                    "machine" : platform.machine() , "cpus" : os.cpu_count() }
+    report = { "config" : config , "environment" : environment , "stages" : {} }
+    print( "{0:<14} {1:>9} {2:>22} {3:>12}".format( "stage" , "seconds" , "throughput" , "peak RSS" ) )
+    for stage in stages:
+        result = spawnStage( args , stage , workdir )
+        report[ "stages" ][ stage ] = result
+        print( "{0:<14} {1:>9.3f} {2:>15.1f} {3:<6} {4:>9.1f} MB".format( stage , result[ "seconds" ] , result[ "throughput" ] , result[ "unit" ] + "/s" , result[ "peak_rss_mb" ] ) )
+
+    output = args.output or os.path.join( workdir , "benchmark.json" )
+    with open( output , "w" ) as writefile:
+        json.dump( report , writefile , indent=2 , sort_keys=True )
+    print( "*** Report written to {} ***".format( output ) )
+
+    ## regressions against the stored baseline
+    regressions = []
+    if args.baseline is not None and os.path.exists( args.baseline ) and not args.save_baseline:
+        with open( args.baseline ) as readfile:
+            baseline = json.load( readfile )
+        for stage , speed , memory , regression in compare( report , baseline , args.tolerance ):
+            print( "{0:<14} throughput {1:+7.1%}   peak RSS {2:+7.1%}{3}".format( stage , speed , memory , "   REGRESSION" if regression else "" ) )
+            if regression:
+                regressions.append( stage )
+    if args.save_baseline:
+        shutil.copyfile( output , args.baseline )
+        print( "*** Baseline written to {} ***".format( args.baseline ) )
+    if regressions:
+        raise SystemExit( "Regressions beyond {0:.0%}: {1}".format( args.tolerance , ", ".join( regressions ) ) )
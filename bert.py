@@ -23,10 +23,11 @@ import sys
 from dataclasses import dataclass, field
 from typing import Optional, Union
 
-import pickle , csv
+import pickle
 import numpy as np
 import torch
 from datasets import load_dataset
+from torch.utils.data import DataLoader, Sampler
 
 import transformers
 from transformers import (
@@ -40,7 +41,14 @@ from transformers import (
     set_seed,
 )
 from transformers.tokenization_utils_base import PaddingStrategy, PreTrainedTokenizerBase
-from transformers.trainer_utils import is_main_process
+from transformers.trainer_utils import PredictionOutput, is_main_process
+
+from artifacts import exampleFile, findExampleFile, loadExamples, readChoiceRows, writeLogits, writeTopRows
+from docstore import openDocStore
+from fusion import alignScores, writeRanking
+from manifest import Manifest
+from scorestore import ScoreStore, missingRows
+from tokencache import buildTokenCache, encodeChoices, openTokenCache, tokenCachePath
 
 
 logger = logging.getLogger(__name__)
@@ -104,14 +112,54 @@ class DataTrainingArguments:
             "efficient on GPU but very bad for TPU."
         },
     )
+    repeat_query: bool = field(
+        default=True,
+        metadata={
+            "help": "Whether the second sentence repeats the query before the document (f\"{query} {doc}\"). "
+            "Without it each choice is (query, doc) and more of the document fits in max_seq_length. "
+            "Prediction must use the setting the model was trained with."
+        },
+    )
+    fusion_alpha: float = field(
+        default=1.15,
+        metadata={"help": "Weight of the first-stage log score in the test reranking; map.py tunes it on the alpha queries."},
+    )
+    cascade_top_k: Optional[int] = field(
+        default=None,
+        metadata={
+            "help": "If set, predict the test queries on their first-stage top k documents only (rounded up to "
+            "whole rows); map.py ranks the rest of each list below them in first-stage order."
+        },
+    )
+    group_size: Optional[int] = field(
+        default=None,
+        metadata={
+            "help": "If set, predict the test queries in rows of this many documents (e.g. 16, fewer forward passes "
+            "per document) instead of the rows preprocessing wrote. Training uses the rows as written."
+        },
+    )
+    max_tokens_per_batch: Optional[int] = field(
+        default=None,
+        metadata={
+            "help": "If set, batch examples of similar length together under this many tokens per batch "
+            "(examples x choices x longest choice) instead of a fixed batch size."
+        },
+    )
+    score_store: Optional[str] = field(
+        default="save/scores.sqlite",
+        metadata={
+            "help": "SQLite store of logits keyed by (checkpoint, query, document): test and alpha rows whose pairs "
+            "are all in it are not predicted again. Empty to predict every row."
+        },
+    )
 
     def __post_init__(self):
         if self.train_file is not None:
             extension = self.train_file.split(".")[-1]
-            assert extension in ["csv", "json"], "`train_file` should be a csv or a json file."
+            assert extension in ["csv", "json", "arrow", "parquet"], "`train_file` should be a csv, json, arrow or parquet file."
         if self.validation_file is not None:
             extension = self.validation_file.split(".")[-1]
-            assert extension in ["csv", "json"], "`validation_file` should be a csv or a json file."
+            assert extension in ["csv", "json", "arrow", "parquet"], "`validation_file` should be a csv, json, arrow or parquet file."
 
 
 @dataclass
@@ -150,11 +198,15 @@ class DataCollatorForMultipleChoice:
         label_name = "label" if "label" in features[0].keys() else "labels"
         labels = [feature.pop(label_name) for feature in features]
         batch_size = len(features)
-        num_choices = len(features[0]["input_ids"])
+        num_choices = max(len(feature["input_ids"]) for feature in features)
+        # One flat list of batch_size * num_choices features, built in a single pass. A row with fewer choices (the
+        # last group of a first-stage list) is padded with one-token choices; their logits are never read, every
+        # consumer takes a row's own documents only. Training rows always have all their choices.
         flattened_features = [
-            [{k: v[i] for k, v in feature.items()} for i in range(num_choices)] for feature in features
+            {k: v[i] if i < len(feature["input_ids"]) else v[0][:1] for k, v in feature.items()}
+            for feature in features
+            for i in range(num_choices)
         ]
-        flattened_features = sum(flattened_features, [])
 
         batch = self.tokenizer.pad(
             flattened_features,
@@ -171,6 +223,159 @@ class DataCollatorForMultipleChoice:
         return batch
 
 
+class TokenBudgetBatchSampler(Sampler):
+    """
+    Batch sampler that groups multiple choice examples of similar length and fills each batch up to a token budget,
+    so that a batch padded by :class:`DataCollatorForMultipleChoice` holds little padding.
+
+    Args:
+        lengths (:obj:`List[int]`):
+            Length of the longest choice of every example.
+        num_choices (:obj:`List[int]`):
+            Number of choices of every example.
+        max_tokens (:obj:`int`):
+            Most tokens, padding included, in one batch: examples x choices x longest choice of the batch. An example
+            larger than the budget gets a batch of its own.
+        shuffle (:obj:`bool`, `optional`, defaults to :obj:`False`):
+            Shuffle the examples within buckets of similar length and the order of the batches, for training.
+            Without it the batches follow increasing length, and :meth:`order` maps the results back.
+        seed (:obj:`int`, `optional`, defaults to 0):
+            Seed of the shuffling, advanced at every epoch.
+        bucket_size (:obj:`int`, `optional`, defaults to 1000):
+            How many shuffled examples are sorted by length together.
+    """
+
+    def __init__(self, lengths, num_choices, max_tokens, shuffle=False, seed=0, bucket_size=1000):
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.num_choices = np.asarray(num_choices, dtype=np.int64)
+        self.max_tokens = max_tokens
+        self.shuffle = shuffle
+        self.seed = seed
+        self.bucket_size = bucket_size
+        self.epoch = 0
+        self.batches = self._plan()
+
+    def _plan(self):
+        if self.shuffle:
+            rng = np.random.default_rng([self.seed, self.epoch])
+            indices = rng.permutation(len(self.lengths))
+            buckets = [indices[i : i + self.bucket_size] for i in range(0, len(indices), self.bucket_size)]
+            indices = np.concatenate(
+                [bucket[np.argsort(self.lengths[bucket], kind="stable")] for bucket in buckets] or [indices]
+            )
+        else:
+            indices = np.argsort(self.lengths, kind="stable")
+        batches, batch, longest, widest = [], [], 0, 0
+        for index in indices.tolist():
+            length, width = max(longest, self.lengths[index]), max(widest, self.num_choices[index])
+            if batch and (len(batch) + 1) * length * width > self.max_tokens:
+                batches.append(batch)
+                batch, length, width = [], self.lengths[index], self.num_choices[index]
+            batch.append(index)
+            longest, widest = length, width
+        if batch:
+            batches.append(batch)
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        return batches
+
+    def order(self):
+        """Dataset index of every example, in the order the batches yield them."""
+        return np.array([index for batch in self.batches for index in batch], dtype=np.int64)
+
+    def __iter__(self):
+        if self.shuffle and self.epoch > 0:
+            self.batches = self._plan()
+        self.epoch += 1
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
+
+
+def choiceLengths(dataset, chunk_size=10000):
+    """Longest choice and number of choices of every tokenized multiple choice example."""
+    lengths, num_choices = [], []
+    for start in range(0, len(dataset), chunk_size):
+        for choices in dataset[start : start + chunk_size]["input_ids"]:
+            lengths.append(max(len(x) for x in choices))
+            num_choices.append(len(choices))
+    return lengths, num_choices
+
+
+class TokenBudgetTrainer(Trainer):
+    """
+    :class:`~transformers.Trainer` that batches with :class:`TokenBudgetBatchSampler` when ``max_tokens_per_batch`` is
+    set, and puts predictions back in dataset order.
+    """
+
+    def __init__(self, *args, max_tokens_per_batch=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.max_tokens_per_batch = max_tokens_per_batch
+        self._prediction_order = None
+
+    def _budget_loader(self, loader, shuffle):
+        lengths, num_choices = choiceLengths(loader.dataset)
+        sampler = TokenBudgetBatchSampler(
+            lengths, num_choices, self.max_tokens_per_batch, shuffle=shuffle, seed=self.args.seed
+        )
+        self._prediction_order = None if shuffle else sampler.order()
+        return DataLoader(
+            loader.dataset,
+            batch_sampler=sampler,
+            collate_fn=loader.collate_fn,
+            num_workers=loader.num_workers,
+            pin_memory=loader.pin_memory,
+        )
+
+    def get_train_dataloader(self):
+        loader = super().get_train_dataloader()
+        return self._budget_loader(loader, shuffle=True) if self.max_tokens_per_batch else loader
+
+    def get_eval_dataloader(self, eval_dataset=None):
+        loader = super().get_eval_dataloader(eval_dataset)
+        return self._budget_loader(loader, shuffle=False) if self.max_tokens_per_batch else loader
+
+    def get_test_dataloader(self, test_dataset):
+        loader = super().get_test_dataloader(test_dataset)
+        return self._budget_loader(loader, shuffle=False) if self.max_tokens_per_batch else loader
+
+    def predict(self, test_dataset, *args, **kwargs):
+        output = super().predict(test_dataset, *args, **kwargs)
+        if not self.max_tokens_per_batch:
+            return output
+        # predictions came in length order, row j of them belongs to example order[j]
+        inverse = np.empty_like(self._prediction_order)
+        inverse[self._prediction_order] = np.arange(len(self._prediction_order))
+        return PredictionOutput(
+            predictions=output.predictions[inverse],
+            label_ids=output.label_ids[inverse] if output.label_ids is not None else None,
+            metrics=output.metrics,
+        )
+
+    def predict_stored(self, test_dataset, rows, store, scorer):
+        """
+        Like :meth:`predict`, with the logits of pairs already in ``store`` under ``scorer`` looked up by key: only
+        the rows with a pair missing from it are predicted, and their logits are added to it.
+
+        Args:
+            rows (:obj:`List[Tuple[str, List[str]]]`):
+                ``(query_name, doc_names)`` of every example of ``test_dataset``, as :func:`readChoiceRows` gives them.
+        """
+        logits = store.lookup(scorer, rows)
+        todo = np.flatnonzero(missingRows(logits, rows))
+        metrics = {}
+        if len(todo):
+            output = self.predict(test_dataset.select(todo))
+            logits[todo, : output.predictions.shape[1]] = output.predictions
+            store.put(scorer, [rows[i] for i in todo], output.predictions)
+            metrics = output.metrics
+        logger.info(f"  {len(rows) - len(todo)} of {len(rows)} rows from the score store")
+        return PredictionOutput(
+            predictions=np.nan_to_num(logits, nan=0.0),
+            label_ids=np.asarray(test_dataset["label"]) if "label" in test_dataset.column_names else None,
+            metrics=metrics,
+        )
 
 
 def main():
@@ -236,8 +441,7 @@ def main():
             data_files["train"] = data_args.train_file
         if data_args.validation_file is not None:
             data_files["validation"] = data_args.validation_file
-        extension = data_args.train_file.split(".")[-1]
-        datasets = load_dataset(extension, data_files=data_files)
+        datasets = loadExamples(data_files)
     else:
         datasets = load_dataset("swag", "regular")
 
@@ -275,61 +479,24 @@ def main():
         dbfile.close()
         return
 
+    # Pre-tokenized documents, shared by the train, validation, alpha and test passes
+    max_length = data_args.max_seq_length if data_args.max_seq_length is not None else tokenizer.model_max_length
+    token_cache_path = tokenCachePath( dic_save , tokenizer , max_length )
+    if data_args.overwrite_cache or not os.path.exists( token_cache_path ):
+        logger.info("*** Tokenizing documents into {} ***".format( token_cache_path ) )
+        buildTokenCache( token_cache_path , openDocStore( dic_save + "docs_store" ) , tokenizer , max_length )
+    # documents missing from the store are scored as the text " None "
+    missing_doc_ids = tokenizer( " None " , add_special_tokens=False )[ "input_ids" ]
+    padding = "max_length" if data_args.pad_to_max_length else False
+
     # Preprocessing the datasets.
     def preprocess_function( data ):
-
-        docs_dict = pickleOpen( dic_save + "docs_dict.pkl" )
-        first_sentences = [ [ query_content ] * 4 for query_content in data['query_content'] ]
-        second_sentences = []
-
-        for tup in zip( data[ 'query_content' ] , data[ 'answer' ] ):
-            pn_list = tup[1].split()
-            for doc_name in pn_list:
-                second_sentences.append( [ f"{tup[0]} {docs_dict[ doc_name ]}" ] )
-
-        # Flatten out
-        first_sentences = sum(first_sentences, [])
-        second_sentences = sum(second_sentences, [])
-
-        # Tokenize
-        tokenized_examples = tokenizer(
-            first_sentences,
-            second_sentences,
-            truncation=True,
-            max_length=data_args.max_seq_length,
-            padding="max_length" if data_args.pad_to_max_length else False,
-        )
-        # Un-flatten
-        return {k: [v[i : i + 4] for i in range(0, len(v), 4)] for k, v in tokenized_examples.items()}
-
+        token_cache = openTokenCache( token_cache_path )
+        return encodeChoices( tokenizer , token_cache , data[ 'query_content' ] , data[ 'answer' ] , max_length , padding , repeat_query=data_args.repeat_query )
 
     def test_preprocess_function( data ):
-
-        docs_dict = pickleOpen( dic_save + "docs_dict.pkl" )
-        first_sentences  = [ [ query_content ] * 4 for query_content in data[ 'query_content' ] ]
-        second_sentences = []
-
-        for tup in zip( data[ 'query_content' ] , data[ 'top1000' ] ):
-            pn_list = tup[1].split()
-            for doc_name in pn_list:
-                a = docs_dict[ doc_name ] if doc_name in docs_dict.keys() and docs_dict[ doc_name ] is not None else " None "
-                second_sentences.append( [ f"{tup[0]} {a}" ] )
-
-        # Flatten out
-        first_sentences = sum(first_sentences, [])
-        second_sentences = sum(second_sentences, [])
-
-        # Tokenize
-        tokenized_examples = tokenizer(
-            first_sentences,
-            second_sentences,
-            truncation=True, 
-            max_length=data_args.max_seq_length,
-            padding="max_length" if data_args.pad_to_max_length else False,
-        )
-
-        # Un-flatten
-        return {k: [v[i : i + 4] for i in range(0, len(v), 4)] for k, v in tokenized_examples.items()}
+        token_cache = openTokenCache( token_cache_path )
+        return encodeChoices( tokenizer , token_cache , data[ 'query_content' ] , data[ 'top1000' ] , max_length , padding , missing_doc_ids , data_args.repeat_query )
 
 
     # Data collator
@@ -354,10 +521,24 @@ def main():
 
     # Preprocessing the test datasets.
     logger.info("*** Preprocessing Test data ***")
+    test_file = findExampleFile( dic_save , "test" )
+    cascade_suffix = "" if data_args.cascade_top_k is None else "-top{}".format( data_args.cascade_top_k )
+    if data_args.cascade_top_k is not None or data_args.group_size is not None:
+        # only the head of each first-stage list, and / or other rows than preprocessing's; predict.py --top_k
+        # --group_size writes the same file
+        # rewritten when the first-stage lists change, the manifest keys it on them
+        manifest = Manifest( dic_save + "manifest.json" )
+        group_size = data_args.group_size or manifest.param( "test" , "group_size" , 4 )
+        group_suffix = "" if data_args.group_size is None else "-g{}".format( data_args.group_size )
+        test_file = exampleFile( dic_save , "test" + cascade_suffix + group_suffix , os.path.splitext( test_file )[1][1:] )
+        manifest.build( os.path.basename( test_file ) , [ dic_save + "test_queries_dict.pkl" , dic_save + "test_que_top_dict.pkl" ] ,
+                        { "top_k" : data_args.cascade_top_k , "group_size" : group_size } , [ test_file ] ,
+                        lambda: writeTopRows( test_file , pickleOpen( dic_save + "test_queries_dict.pkl" ) , pickleOpen( dic_save + "test_que_top_dict.pkl" ) , data_args.cascade_top_k , group_size ) ,
+                        data_args.overwrite_cache )
     try:
         test_data_files = {}
-        test_data_files["train"] = dic_save + "test.csv"
-        testdata = load_dataset("csv", data_files=test_data_files)
+        test_data_files["train"] = test_file
+        testdata = loadExamples(test_data_files)
         # testdata = load_dataset( "csv" , data_files=dic_save + "test.csv" )
         tokenized_test_datasets = testdata.map(
             test_preprocess_function,
@@ -369,7 +550,7 @@ def main():
         logger.info("*** An exception occurred: test data error ***")
 
     # Initialize our Trainer
-    trainer = Trainer(
+    trainer = TokenBudgetTrainer(
         model=model,
         args=training_args,
         train_dataset=tokenized_datasets["train"] if training_args.do_train else None,
@@ -377,6 +558,7 @@ def main():
         tokenizer=tokenizer,
         data_collator=data_collator,
         compute_metrics=compute_metrics,
+        max_tokens_per_batch=data_args.max_tokens_per_batch,
     )
 
     torch.cuda.empty_cache()
@@ -427,10 +609,23 @@ def main():
     except:
         logger.info("*** An exception occurred: Evaluation error ***")
 
+    # logits of the checkpoint being predicted with, kept by ( query , document ) across runs
+    score_store = scorer = None
+    if data_args.score_store:
+        score_store = ScoreStore( data_args.score_store )
+        scorer = score_store.scorer(
+            training_args.output_dir if training_args.do_train else model_args.model_name_or_path ,
+            max_length=max_length , repeat_query=data_args.repeat_query , precision="fp16" if training_args.fp16 else "fp32" ,
+        )
+
     # Test
     try:
         logger.info("*** Predict Test dataset ***")
-        trainer_test_result = trainer.predict( test_dataset=tokenized_test_datasets["train"] )
+        test_rows = readChoiceRows( test_file )
+        if score_store is not None:
+            trainer_test_result = trainer.predict_stored( tokenized_test_datasets["train"] , test_rows , score_store , scorer )
+        else:
+            trainer_test_result = trainer.predict( test_dataset=tokenized_test_datasets["train"] )
         print( "trainer_test_result type: {}".format( type( trainer_test_result ) ) )
     except:
         logger.info("*** An exception occurred: Predict Test error ***")
@@ -448,14 +643,15 @@ def main():
 
     try:
         logger.info("*** Save Predict Test Result ***")
-        pickleStore( trainer_test_result , dic_save + "trainer_test_result.pkl" )
+        # float32 logits and the ( query , documents ) of every row, map.py memory-maps them
+        writeLogits( dic_save + "trainer_test_result{}.npy".format( cascade_suffix ) , test_rows , trainer_test_result.predictions )
     except:
         logger.info("*** An exception occurred: Save Predict error ***")
 
     # predict for training alpha
     try:
         logger.info("*** Predict for Training Alpha ***")
-        alphadata = load_dataset( "csv" , data_files=dic_save + "train_for_alpha_train.csv" )
+        alphadata = loadExamples( { "train" : findExampleFile( dic_save , "train_for_alpha_train" ) } )
         tokenized_alpha_datasets = alphadata.map(
             preprocess_function,
             batched=True,
@@ -466,8 +662,8 @@ def main():
         logger.info("*** An exception occurred: Predict Alpha Data error first time, try again ***")
         try:
             alpha_data_files = {}
-            alpha_data_files["train"] = dic_save + "train_for_alpha_train.csv"
-            alphadata = load_dataset("csv", data_files=test_data_files)
+            alpha_data_files["train"] = findExampleFile( dic_save , "train_for_alpha_train" )
+            alphadata = loadExamples(alpha_data_files)
             tokenized_alpha_datasets = alphadata.map(
                 preprocess_function,
                 batched=True,
@@ -478,54 +674,28 @@ def main():
             logger.info("*** An exception occurred: Predict Alpha Data error 2 times ***")
 
     try:
-        trainer_alpha_result = trainer.predict( test_dataset=tokenized_alpha_datasets["train"] )
+        alpha_rows = readChoiceRows( findExampleFile( dic_save , "train_for_alpha_train" ) )
+        if score_store is not None:
+            trainer_alpha_result = trainer.predict_stored( tokenized_alpha_datasets["train"] , alpha_rows , score_store , scorer )
+        else:
+            trainer_alpha_result = trainer.predict( test_dataset=tokenized_alpha_datasets["train"] )
     except:
         logger.info("*** An exception occurred: Predict Alpha error ***")
 
     try:
         logger.info("*** Save Predict Alpha Result ***")
-        pickleStore( trainer_alpha_result , dic_save + "trainer_alpha_result.pkl" )
+        writeLogits( dic_save + "trainer_alpha_result.npy" , alpha_rows , trainer_alpha_result.predictions )
     except:
         logger.info("*** An exception occurred: Save Predict alpha error ***")
 
     # calculate documents ranking for test
     logger.info("*** Caculate Reranking Result ***")
-
-    def softmax( vector ):
-        e = np.exp( vector )
-        return e / e.sum()
-
     try:
-        save = {}
-        tmp  = {}
-        new  = {}
-        pre_result = trainer_test_result[0]
-        with open( dic_save + 'test.csv' , newline='' ) as csvfile:
-            spamreader = csv.reader( csvfile , delimiter=',' )
-            next(spamreader)
-            for c , row in enumerate( spamreader ):
-                if row[0] not in save.keys():
-                    save[ row[0] ] = {}
-                for tup in zip( row[2].split() , pre_result[c].tolist() ):
-                    save[ row[0] ][ tup[0] ] = tup[1]
-            # sort
-            save = { query_name : dict( sorted( d_v.items(), key=lambda item: item[1] , reverse=True ) ) for query_name , d_v in save.items() }
-            # compute softmax
-            for query_name , d_v in save.items():
-                tmp[ query_name ] = softmax( np.array( list( save[ query_name ].values() ) , dtype=np.float64 ) ).tolist()
-            save = { query_name : dict( zip( list( save[ query_name ].keys() ) , tmp[ query_name ] ) ) for query_name in save.keys() }
-        
         que_top_dict = pickleOpen( dic_save + "test_que_top_dict.pkl" )
-        for query_name , d_v in que_top_dict.items():
-            for doc_name , softmax_score in d_v.items():
-                new[ query_name ][ doc_name ] = np.log2( save[ query_name ][ doc_name ] ) + 1.15 * np.log2( softmax_score )
-        pickleStore( new , dic_save + "test_ques_docs_reranking.pkl" )
-
-        with open( dic_save + "test_ques_docs_reranking.csv" , "a" ) as writefile:
-            writefile.write( "query_id,ranked_doc_ids\n" )
-            for query_name , d_v in new.items():
-                append = ",".join( [ str( query_name ) , " ".join( sorted( d_v , key=d_v.get , reverse=True ) ) ] )
-                writefile.write( append + "\n" )
+        test_matrix = alignScores( test_rows , trainer_test_result.predictions , que_top_dict )
+        scores = test_matrix.fuse( data_args.fusion_alpha )
+        pickleStore( test_matrix.rerankDict( scores ) , dic_save + "test_ques_docs_reranking.pkl" )
+        writeRanking( dic_save + "test_ques_docs_reranking.csv" , test_matrix , scores , que_top_dict )
     except:
         logger.info("*** Caculate Reranking Result Error ***")
 
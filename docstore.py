@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import os , mmap
+import numpy as np
+
+
+## on-disk document store
+# docs.bin  : every document as UTF-8, one after another
+# ids.npy   : document names, sorted
+# spans.npy : ( offset , length ) of each document inside docs.bin, same order as ids.npy
+# all three files are memory-mapped, so opening a store costs nothing and every
+# process reading it shares one read-only copy of the corpus through the page cache
+
+
+# position of name in the sorted array ids, -1 when absent
+def findName( ids , name ):
+    i = int( np.searchsorted( ids , name ) )
+    if i < len( ids ) and ids[ i ] == name:
+        return i
+    return -1
+
+
+## passages of long documents, kept in a store of their own ( save/passage_store )
+# passage i of a document is named "{doc_name}#{i}", windows of words overlapping by words - stride
+# a document gets at most max_passages of them, from its start
+
+
+def splitPassages( text , words=150 , stride=75 , max_passages=None ):
+    tokens = text.split()
+    starts = list( range( 0 , max( len( tokens ) - words , 0 ) + 1 , stride ) )
+    # the last window reaches the end of the document
+    if starts[ -1 ] + words < len( tokens ):
+        starts.append( len( tokens ) - words )
+    return [ " ".join( tokens[ start : start + words ] ) for start in starts[ : max_passages ] ]
+
+
+def passageName( doc_name , i ):
+    return "{0}#{1}".format( doc_name , i )
+
+
+def passageDoc( passage_name ):
+    return passage_name.rsplit( "#" , 1 )[0]
+
+
+def passageNames( passage_store , doc_name ):
+    # names of the document's passages, first passage first; ids are sorted, "$" follows "#"
+    lo = int( np.searchsorted( passage_store.ids , doc_name + "#" ) )
+    hi = int( np.searchsorted( passage_store.ids , doc_name + "$" ) )
+    return sorted( map( str , passage_store.ids[ lo : hi ] ) , key=lambda name: int( name.rsplit( "#" , 1 )[1] ) )
+
+
+class DocStoreWriter:
+
+    def __init__( self , path ):
+        self.path = path
+        if not os.path.exists( path ):
+            os.makedirs( path )
+        self._blob   = open( os.path.join( path , "docs.bin" ) , "wb" )
+        self._ids    = []
+        self._spans  = []
+        self._offset = 0
+
+    def add( self , doc_name , text ):
+        data = text.encode( "utf-8" )
+        self._blob.write( data )
+        self._ids.append( doc_name )
+        self._spans.append( ( self._offset , len( data ) ) )
+        self._offset += len( data )
+
+    def close( self ):
+        self._blob.close()
+        # a name seen twice keeps its last text, as the old dict did
+        last = { doc_name : i for i , doc_name in enumerate( self._ids ) }
+        names = sorted( last.keys() )
+        ids   = np.array( names , dtype=str ) if names else np.zeros( 0 , dtype="<U1" )
+        spans = np.array( [ self._spans[ last[ doc_name ] ] for doc_name in names ] , dtype=np.int64 ).reshape( -1 , 2 )
+        np.save( os.path.join( self.path , "ids.npy" ) , ids )
+        np.save( os.path.join( self.path , "spans.npy" ) , spans )
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self , *exc ):
+        self.close()
+
+
+class MappedByPath:
+    # pickled by path only, the receiving process maps the files itself
+    def __getstate__( self ):
+        return { "path" : self.path }
+
+    def __setstate__( self , state ):
+        self.__init__( state[ "path" ] )
+
+
+class DocStore( MappedByPath ):
+
+    def __init__( self , path ):
+        self.path  = path
+        self.ids   = np.load( os.path.join( path , "ids.npy" ) , mmap_mode="r" )
+        self.spans = np.load( os.path.join( path , "spans.npy" ) , mmap_mode="r" )
+        self._file = open( os.path.join( path , "docs.bin" ) , "rb" )
+        if os.fstat( self._file.fileno() ).st_size > 0:
+            self.blob = mmap.mmap( self._file.fileno() , 0 , access=mmap.ACCESS_READ )
+        else:
+            self.blob = b""
+
+    def _position( self , doc_name ):
+        return findName( self.ids , doc_name )
+
+    def __getitem__( self , doc_name ):
+        i = self._position( doc_name )
+        if i < 0:
+            raise KeyError( doc_name )
+        offset , length = self.spans[ i ]
+        return self.blob[ offset : offset + length ].decode( "utf-8" )
+
+    def get( self , doc_name , default=None ):
+        try:
+            return self[ doc_name ]
+        except KeyError:
+            return default
+
+    def __contains__( self , doc_name ):
+        return self._position( doc_name ) >= 0
+
+    def __len__( self ):
+        return len( self.ids )
+
+    def __iter__( self ):
+        return ( str( doc_name ) for doc_name in self.ids )
+
+    def keys( self ):
+        return iter( self )
+
+
+# stores already opened by this process, keyed by path
+# datasets.map workers import this module on their own, so each worker maps
+# the store once instead of reopening it for every batch
+_stores = {}
+
+
+def openDocStore( path ):
+    if path not in _stores:
+        _stores[ path ] = DocStore( path )
+    return _stores[ path ]
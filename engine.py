@@ -0,0 +1,184 @@
+# coding=utf-8
+"""
+CPU inference engines for the fine-tuned multiple choice model.
+
+`python engine.py --model_name_or_path <output_dir of bert.py>` exports the model to TorchScript or ONNX, by default
+with dynamic int8 quantization of its linear layers, into <model>/engine-<format>[-int8]/ next to a copy of the
+tokenizer. The batch, choice and sequence axes stay dynamic, so the same engine scores rows of any number of choices
+and the single-choice rows of pointwise scoring. `predict.py --engine <dir>` scores with it instead of the eager model.
+
+ONNX export needs the onnx and onnxruntime packages, TorchScript only torch.
+"""
+
+import inspect
+import json
+import logging
+import os
+import sys
+from dataclasses import dataclass, field
+from typing import Optional
+
+import numpy as np
+import torch
+from transformers import AutoModelForMultipleChoice, AutoTokenizer, HfArgumentParser
+
+
+logger = logging.getLogger(__name__)
+
+FORMATS = ("torchscript", "onnx")
+# inputs of engines exported before engine.json listed them
+INPUT_NAMES = ["input_ids", "attention_mask", "token_type_ids"]
+
+
+@dataclass
+class ExportArguments:
+    """
+    Arguments pertaining to which model is exported, to which format and how.
+    """
+
+    model_name_or_path: str = field(metadata={"help": "Fine-tuned model directory (the output_dir of bert.py)"})
+    format: str = field(default="torchscript", metadata={"help": "torchscript or onnx"})
+    quantize: bool = field(default=True, metadata={"help": "Dynamic int8 quantization of the linear layers"})
+    output_dir: Optional[str] = field(
+        default=None, metadata={"help": "Engine directory, <model>/engine-<format>[-int8] by default"}
+    )
+    opset: int = field(default=14, metadata={"help": "ONNX opset"})
+
+
+def engineDir(model_name_or_path, format="torchscript", quantize=True):
+    return os.path.join(model_name_or_path, "engine-{}{}".format(format, "-int8" if quantize else ""))
+
+
+def inputNames(tokenizer, model):
+    """The tokenizer's inputs (no token_type_ids for models without segments), in the order forward takes them."""
+    parameters = list(inspect.signature(model.forward).parameters)
+    names = [name for name in parameters if name in tokenizer.model_input_names]
+    if names != parameters[: len(names)]:
+        raise ValueError(f"Inputs {names} are not the leading arguments of {type(model).__name__}.forward, cannot trace them.")
+    return names
+
+
+def _exampleInputs(tokenizer, input_names):
+    encoded = tokenizer(["an example query"] * 2, ["an example document"] * 2, return_tensors="pt")
+    # ( 1 row , 2 choices , length ): none of the three axes may be baked into the graph
+    return tuple(encoded[name][None] for name in input_names)
+
+
+def exportEngine(model_name_or_path, output_dir, format="torchscript", quantize=True, opset=14):
+    """Export the multiple choice model of model_name_or_path to output_dir, returns the engine meta."""
+    if format not in FORMATS:
+        raise ValueError(f"Unknown engine format {format}, use torchscript or onnx.")
+    tokenizer = AutoTokenizer.from_pretrained(model_name_or_path)
+    model = AutoModelForMultipleChoice.from_pretrained(model_name_or_path, torchscript=True)
+    model.eval()
+    input_names = inputNames(tokenizer, model)
+    inputs = _exampleInputs(tokenizer, input_names)
+    os.makedirs(output_dir, exist_ok=True)
+
+    if format == "torchscript":
+        if quantize:
+            model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        with torch.no_grad():
+            traced = torch.jit.trace(model, inputs, strict=False)
+        torch.jit.save(torch.jit.freeze(traced), os.path.join(output_dir, "model.pt"))
+        model_file = "model.pt"
+    else:
+        try:
+            from onnxruntime.quantization import QuantType, quantize_dynamic
+        except ImportError:
+            raise ImportError("ONNX engines need onnx and onnxruntime: pip install onnx onnxruntime")
+        axes = {0: "batch", 1: "choice", 2: "sequence"}
+        fp32_file = os.path.join(output_dir, "model-fp32.onnx")
+        torch.onnx.export(
+            model,
+            inputs,
+            fp32_file,
+            input_names=input_names,
+            output_names=["logits"],
+            dynamic_axes=dict({name: axes for name in input_names}, logits={0: "batch", 1: "choice"}),
+            opset_version=opset,
+            dynamo=False,
+        )
+        model_file = "model-fp32.onnx"
+        if quantize:
+            quantize_dynamic(fp32_file, os.path.join(output_dir, "model.onnx"), weight_type=QuantType.QInt8)
+            os.remove(fp32_file)
+            model_file = "model.onnx"
+
+    tokenizer.save_pretrained(output_dir)
+    meta = {
+        "format": format,
+        "quantized": quantize,
+        "model_file": model_file,
+        "input_names": input_names,
+        "source": os.path.abspath(model_name_or_path),
+    }
+    with open(os.path.join(output_dir, "engine.json"), "w") as f:
+        json.dump(meta, f, indent=2)
+    return meta
+
+
+class TorchScriptEngine:
+    """Frozen TorchScript module, torch intra-op threads set by the caller."""
+
+    def __init__(self, path, threads=None, input_names=INPUT_NAMES):
+        if threads is not None:
+            torch.set_num_threads(threads)
+        self.module = torch.jit.load(path, map_location="cpu")
+        # traced positionally, in this order
+        self.input_names = input_names
+
+    def __call__(self, batch):
+        with torch.no_grad():
+            return self.module(*[batch[name] for name in self.input_names])[0].float().numpy()
+
+
+class OnnxEngine:
+    """ONNX Runtime session on the CPU, threads intra-op threads and one inter-op thread."""
+
+    def __init__(self, path, threads=None):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        if threads is not None:
+            options.intra_op_num_threads = threads
+        options.inter_op_num_threads = 1
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = onnxruntime.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        self.input_names = {x.name for x in self.session.get_inputs()}
+
+    def __call__(self, batch):
+        feeds = {name: batch[name].numpy().astype(np.int64) for name in self.input_names}
+        return self.session.run(None, feeds)[0]
+
+
+def loadEngine(engine_dir, threads=None):
+    """The engine exported to engine_dir, called on a collated batch it returns (rows, choices) logits."""
+    with open(os.path.join(engine_dir, "engine.json")) as f:
+        meta = json.load(f)
+    path = os.path.join(engine_dir, meta["model_file"])
+    if meta["format"] == "onnx":
+        return OnnxEngine(path, threads)
+    return TorchScriptEngine(path, threads, meta.get("input_names", INPUT_NAMES))
+
+
+def main():
+    parser = HfArgumentParser(ExportArguments)
+    if len(sys.argv) == 2 and sys.argv[1].endswith(".json"):
+        (args,) = parser.parse_json_file(json_file=os.path.abspath(sys.argv[1]))
+    else:
+        (args,) = parser.parse_args_into_dataclasses()
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(name)s -   %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+        level=logging.INFO,
+    )
+
+    output_dir = args.output_dir or engineDir(args.model_name_or_path, args.format, args.quantize)
+    logger.info(f"*** Export {args.model_name_or_path} to {output_dir} ***")
+    meta = exportEngine(args.model_name_or_path, output_dir, args.format, args.quantize, args.opset)
+    logger.info(f"*** Done! {meta} ***")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import numpy as np
+
+
+## ranking metrics over all queries at once
+# rankings   : ( ... , queries , depth ) int doc ids, best first, -1 pads a short ranking
+# relevant   : ( ... , queries , depth ) bool, True where the ranked doc is relevant
+# n_relevant : ( queries , ) relevant docs of each query, retrieved or not
+# leading axes ( e.g. one per alpha ) are kept, metrics are taken over the last axis
+
+
+def encodeRuns( rank_lists , answer_lists ):
+    # doc names to ints, one id per distinct name over rankings and answers
+    vocab = {}
+    depth = max( [ len( x ) for x in rank_lists ] + [ 0 ] )
+    rankings = np.full( ( len( rank_lists ) , depth ) , -1 , dtype=np.int64 )
+    for i , rank_list in enumerate( rank_lists ):
+        rankings[ i , : len( rank_list ) ] = [ vocab.setdefault( doc , len( vocab ) ) for doc in rank_list ]
+    answers = [ np.unique( [ vocab.setdefault( doc , len( vocab ) ) for doc in answer_list ] ).astype( np.int64 ) for answer_list in answer_lists ]
+    relevant = relevanceMask( rankings , answers , len( vocab ) )
+    n_relevant = np.array( [ len( x ) for x in answers ] , dtype=np.int64 )
+    return rankings , relevant , n_relevant
+
+
+def relevanceMask( rankings , answers , n_docs=None ):
+    # answers : one int array of relevant doc ids per query
+    # a ( query , doc ) pair is one key, so every query is matched in a single isin
+    if n_docs is None:
+        n_docs = max( [ int( rankings.max( initial=-1 ) ) ] + [ int( x.max( initial=-1 ) ) for x in answers ] ) + 1
+    queries = np.arange( rankings.shape[-2] , dtype=np.int64 )
+    keys = queries[ : , None ] * n_docs + rankings
+    answer_keys = np.concatenate( [ np.zeros( 0 , dtype=np.int64 ) ] + [ q * n_docs + np.asarray( x , dtype=np.int64 ) for q , x in enumerate( answers ) ] )
+    return np.isin( keys , answer_keys ) & ( rankings >= 0 )
+
+
+def _depth( relevant , k ):
+    return relevant[ ... , :k ] if k is not None else relevant
+
+
+def averagePrecision( relevant , n_relevant , k=None ):
+    # AP@k is divided by min( n_relevant , k ), plain AP by n_relevant
+    rel = _depth( relevant , k ).astype( np.float64 )
+    hits = np.cumsum( rel , axis=-1 )
+    precision = hits / np.arange( 1 , rel.shape[-1] + 1 )
+    denominator = np.asarray( n_relevant , dtype=np.float64 )
+    if k is not None:
+        denominator = np.minimum( denominator , k )
+    return ( precision * rel ).sum( axis=-1 ) / np.maximum( denominator , 1 )
+
+
+def meanAveragePrecision( relevant , n_relevant , k=None ):
+    return averagePrecision( relevant , n_relevant , k ).mean( axis=-1 )
+
+
+def ndcg( relevant , n_relevant , k=None ):
+    # binary gains
+    rel = _depth( relevant , k ).astype( np.float64 )
+    discount = 1.0 / np.log2( np.arange( 2 , rel.shape[-1] + 2 ) )
+    dcg = ( rel * discount ).sum( axis=-1 )
+    # the ideal ranking puts min( n_relevant , k ) relevant docs first, however deep this ranking is
+    n_ideal = np.asarray( n_relevant , dtype=np.int64 )
+    if k is not None:
+        n_ideal = np.minimum( n_ideal , k )
+    ideal = np.concatenate( [ [ 0.0 ] , np.cumsum( 1.0 / np.log2( np.arange( 2 , int( n_ideal.max( initial=0 ) ) + 2 ) ) ) ] )
+    idcg = ideal[ n_ideal ]
+    return np.where( idcg > 0 , dcg / np.where( idcg > 0 , idcg , 1 ) , 0.0 )
+
+
+def recall( relevant , n_relevant , k=None ):
+    hits = _depth( relevant , k ).sum( axis=-1 )
+    return hits / np.maximum( np.asarray( n_relevant , dtype=np.float64 ) , 1 )
@@ -0,0 +1,361 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import numpy as np
+from itertools import chain, count
+
+from evaluation import averagePrecision, relevanceMask
+from numerics import segmentLogSoftmax
+
+
+## score fusion over dense per-query matrices
+# every query is one row, its candidate documents are the columns
+# docs  : ( Q , D ) int ids into doc_names, -1 pads a query with fewer candidates;
+#         every query has its own block of doc_names, so a name shared by two queries has two ids
+# bert  : ( Q , D ) log2 softmax of the BERT logits over the query's candidates
+# first : ( Q , D ) log2 first-stage softmax score
+# rank  : ( Q , D ) position in the first-stage list, past its end for documents outside it
+# group : ( Q , D ) log2 softmax of the BERT logit over the choices of its own row
+# a fused score is bert + alpha * first, the log of the old softmax product, or a learned
+# weighting of every feature in FEATURES
+
+
+FEATURES = ( "bert" , "first" , "group" , "bert_z" , "first_z" , "bert_rank" , "first_rank" )
+
+
+class ScoreMatrix:
+
+    def __init__( self , queries , doc_names , docs , bert , first , rank=None , group=None ):
+        self.queries   = queries
+        self.index     = { query_name : i for i , query_name in enumerate( queries ) }
+        self.doc_names = doc_names
+        self.docs      = docs
+        self.bert      = bert
+        self.first     = first
+        self.rank      = rank if rank is not None else np.argsort( np.argsort( -first , axis=-1 , kind="stable" ) , axis=-1 )
+        self.group     = group if group is not None else bert
+        self.mask      = docs >= 0
+
+    def relevant( self , answers ):
+        # answers : { query_name : space separated answer docs }
+        # one id per distinct name, answers never seen as candidates get fresh ids, they still count as relevant
+        ids = {}
+        name_ids , ids = _packIds( np.fromiter( map( ids.setdefault , self.doc_names , count() ) , dtype=np.int64 , count=len( self.doc_names ) ) , ids )
+        docs = np.where( self.mask , name_ids[ np.maximum( self.docs , 0 ) ] , -1 )
+        answer_ids = [ np.array( [ ids.setdefault( doc_name , len( ids ) ) for doc_name in set( answers[ query_name ].split() ) ] , dtype=np.int64 ) for query_name in self.queries ]
+        relevant = relevanceMask( docs , answer_ids , len( ids ) )
+        n_relevant = np.array( [ len( x ) for x in answer_ids ] , dtype=np.int64 )
+        return relevant , n_relevant
+
+    def fuse( self , alphas ):
+        # alphas : scalar or ( A , ) array, gives ( Q , D ) or ( A , Q , D ); padding scores -inf
+        alphas = np.asarray( alphas , dtype=np.float64 )
+        scores = self.bert + alphas[ ... , None , None ] * self.first
+        return np.where( self.mask , scores , -np.inf )
+
+    def features( self ):
+        # ( Q , D , len( FEATURES ) ), padding 0
+        # _z : standardized over the query's candidates, _rank : 1 / log2( 2 + rank ), best first
+        n = np.maximum( self.mask.sum( axis=-1 , keepdims=True ) , 1 )
+        def standardize( x ):
+            mean = np.where( self.mask , x , 0.0 ).sum( axis=-1 , keepdims=True ) / n
+            std = np.sqrt( np.where( self.mask , ( x - mean ) ** 2 , 0.0 ).sum( axis=-1 , keepdims=True ) / n )
+            return ( x - mean ) / np.where( std > 0 , std , 1.0 )
+        bert_rank = np.argsort( np.argsort( -np.where( self.mask , self.bert , -np.inf ) , axis=-1 , kind="stable" ) , axis=-1 )
+        columns = [ self.bert , self.first , self.group , standardize( self.bert ) , standardize( self.first ) , 1.0 / np.log2( 2.0 + bert_rank ) , 1.0 / np.log2( 2.0 + self.rank ) ]
+        return np.where( self.mask[ ... , None ] , np.stack( columns , axis=-1 ) , 0.0 )
+
+    def cascade( self , scores , top_k ):
+        # only the first-stage top_k went through BERT: the rest follows, in first-stage order,
+        # below the lowest fused score of the query
+        head = self.rank < top_k
+        floor = np.where( head & self.mask , scores , np.inf ).min( axis=-1 , keepdims=True )
+        floor = np.where( np.isfinite( floor ) , floor , 0.0 )
+        top   = np.where( ~head & self.mask , self.first , -np.inf ).max( axis=-1 , keepdims=True )
+        tail  = self.first - np.where( np.isfinite( top ) , top , 0.0 ) + floor - 1.0
+        return np.where( self.mask , np.where( head , scores , tail ) , -np.inf )
+
+    def ranking( self , scores , top_k=None ):
+        # column order of each row, best first ( padding last ); with top_k only the first top_k columns,
+        # partitioned out before they are sorted
+        if top_k is None or top_k >= scores.shape[-1]:
+            return np.argsort( -scores , axis=-1 , kind="stable" )
+        head = np.argpartition( -scores , top_k - 1 , axis=-1 )[ ... , :top_k ]
+        order = np.argsort( -np.take_along_axis( scores , head , axis=-1 ) , axis=-1 , kind="stable" )
+        return np.take_along_axis( head , order , axis=-1 )
+
+    def rankedLists( self , scores , top_k=None ):
+        # { query_name : [ doc_name , ... ] } best first
+        names = np.array( self.doc_names + [ None ] , dtype=object )
+        ranked = np.take_along_axis( self.docs , self.ranking( scores , top_k ) , axis=-1 )
+        return { query_name : names[ ranked[ i ][ ranked[ i ] >= 0 ] ].tolist() for query_name , i in self.index.items() }
+
+    def rerankDict( self , scores ):
+        # { query_name : { doc_name : score } } in ranked order, the old rerank pickle layout
+        new = {}
+        order = self.ranking( scores )
+        for query_name , i in self.index.items():
+            new[ query_name ] = { self.doc_names[ self.docs[ i , j ] ] : float( scores[ i , j ] ) for j in order[ i ] if self.mask[ i , j ] }
+        return new
+
+
+def _packIds( ids , vocab ):
+    # sparse ids to 0 .. len( vocab ) - 1 in first-seen order
+    table = np.zeros( int( ids.max( initial=-1 ) ) + 1 , dtype=np.int64 )
+    table[ np.fromiter( vocab.values() , dtype=np.int64 , count=len( vocab ) ) ] = np.arange( len( vocab ) )
+    return table[ ids ] , dict( zip( vocab.keys() , range( len( vocab ) ) ) )
+
+
+def alignScores( rows , logits , que_top_dict , queries=None ):
+    # rows   : ( query_name , [ doc_name , ... ] ) per prediction row, same order as logits
+    # logits : ( rows , choices ) BERT logits, a row with fewer documents ignores its last columns
+    # a document scored twice keeps its last logit, as the old dict did; queries and their documents
+    # keep the order they first appear in
+    if queries is not None:
+        keep = [ i for i , row in enumerate( rows ) if row[0] in queries ]
+        rows , logits = [ rows[ i ] for i in keep ] , np.asarray( logits )[ keep ]
+    logits  = np.asarray( logits , dtype=np.float64 ).reshape( len( rows ) , -1 )
+    lengths = np.array( [ len( row[1] ) for row in rows ] , dtype=np.int64 )
+    flat_logit = logits[ np.arange( logits.shape[1] ) < lengths[ : , None ] ]
+    starts = np.cumsum( lengths ) - lengths
+    # every row is one segment of the flat choices
+    flat_group = segmentLogSoftmax( flat_logit , starts , base=2 )
+    query_ids = {}
+    row_query = np.array( [ query_ids.setdefault( row[0] , len( query_ids ) ) for row in rows ] , dtype=np.int64 )
+    query_names = list( query_ids.keys() )
+    # without first-stage lists ( que_top_dict None ) every first-stage score is 0
+    tops = [ que_top_dict[ query_name ] if que_top_dict is not None else {} for query_name in query_names ]
+    list_lengths = np.array( [ len( top ) for top in tops ] , dtype=np.int64 )
+
+    # rows grouped by query, file order kept inside a query; flat_index maps the grouped choices back
+    order = np.argsort( row_query , kind="stable" )
+    bounds = np.searchsorted( row_query[ order ] , np.arange( len( query_names ) + 1 ) )
+    grouped_lengths = lengths[ order ]
+    flat_index = np.arange( int( lengths.sum() ) ) + np.repeat( starts[ order ] - ( np.cumsum( grouped_lengths ) - grouped_lengths ) , grouped_lengths )
+
+    # a document of query i is its position in the first-stage list, or a position after it when it is
+    # not in the list; the small per-query dicts stay in cache, one dict over all names would not
+    doc_names , local , offsets = [] , [] , np.zeros( len( query_names ) , dtype=np.int64 )
+    for i , top in enumerate( tops ):
+        position = dict( zip( top , count() ) )
+        group = order[ bounds[ i ] : bounds[ i + 1 ] ]
+        # setdefault with a counter burns a value on every call, the table packs the sparse ids
+        ids = np.fromiter( map( position.setdefault , chain.from_iterable( rows[ r ][1] for r in group ) , count( len( top ) ) ) , dtype=np.int64 , count=int( lengths[ group ].sum() ) )
+        table = np.zeros( int( ids.max( initial=len( top ) - 1 ) ) + 1 , dtype=np.int64 )
+        table[ np.fromiter( position.values() , dtype=np.int64 , count=len( position ) ) ] = np.arange( len( position ) )
+        local.append( table[ ids ] )
+        offsets[ i ] = len( doc_names )
+        doc_names.extend( position )
+    local = np.concatenate( [ np.zeros( 0 , dtype=np.int64 ) ] + local )
+    grouped_query = np.repeat( np.arange( len( query_names ) ) , np.bincount( row_query , weights=lengths , minlength=len( query_names ) ).astype( np.int64 ) )
+
+    # one entry per ( query , doc ): value of the last occurrence, column of the first
+    width = int( local.max( initial=0 ) ) + 1
+    keys = grouped_query * width + local
+    unique , first = np.unique( keys , return_index=True )
+    last = len( keys ) - 1 - np.unique( keys[ ::-1 ] , return_index=True )[1]
+    sort = np.argsort( first )
+    entry_query , entry_local = unique[ sort ] // width , unique[ sort ] % width
+    entry_logit = flat_logit[ flat_index[ last[ sort ] ] ]
+    entry_group = flat_group[ flat_index[ last[ sort ] ] ]
+    counts = np.bincount( entry_query , minlength=len( query_names ) )
+    column = np.arange( len( entry_query ) ) - np.repeat( np.cumsum( counts ) - counts , counts )
+
+    shape = ( len( query_names ) , int( counts.max( initial=0 ) ) )
+    docs = np.full( shape , -1 , dtype=np.int64 )
+    docs[ entry_query , column ] = offsets[ entry_query ] + entry_local
+    mask = docs >= 0
+    # entries are grouped by query, every query is one segment
+    bert = np.zeros( shape , dtype=np.float64 )
+    bert[ entry_query , column ] = segmentLogSoftmax( entry_logit , np.cumsum( counts ) - counts , base=2 )
+    group = np.zeros( shape , dtype=np.float64 )
+    group[ entry_query , column ] = entry_group
+
+    # first-stage probabilities, in list order, right after each query's offset in doc_names
+    prob = np.fromiter( chain.from_iterable( top.values() for top in tops ) , dtype=np.float64 , count=int( list_lengths.sum() ) )
+    in_list = entry_local < list_lengths[ entry_query ]
+    first = np.full( shape , np.nan , dtype=np.float64 )
+    # a probability that underflowed to 0 counts as the smallest double, finite and below every other one
+    first[ entry_query[ in_list ] , column[ in_list ] ] = np.log2( np.maximum( prob[ ( np.cumsum( list_lengths ) - list_lengths )[ entry_query[ in_list ] ] + entry_local[ in_list ] ] , np.nextafter( 0.0 , 1.0 ) ) )
+    # documents outside the first-stage list rank below everything in it
+    with np.errstate( all="ignore" ):
+        floor = np.fmin.reduce( np.where( mask , first , np.nan ) , axis=-1 )
+    floor = np.where( np.isnan( floor ) , np.log2( 1.0 / np.maximum( list_lengths , 1 ) ) , floor )
+    first = np.where( mask , np.where( np.isnan( first ) , floor[ : , None ] , first ) , 0.0 )
+    rank = np.zeros( shape , dtype=np.int64 )
+    rank[ entry_query , column ] = np.minimum( entry_local , list_lengths[ entry_query ] )
+    return ScoreMatrix( query_names , doc_names , docs , bert , first , rank , group )
+
+
+def _relevantColumns( relevant ):
+    # columns of the relevant candidates, padded to the query with the most of them
+    width = int( relevant.sum( axis=-1 ).max( initial=0 ) )
+    cols  = np.argsort( ~relevant , axis=-1 , kind="stable" )[ : , :width ]
+    found = np.take_along_axis( relevant , cols , axis=-1 )
+    return cols , found
+
+
+def _meanAP( scores , relevant , n_relevant , cols , found ):
+    # MAP of every leading index of ( ... , Q , D ) scores
+    width = cols.shape[-1]
+    if width <= 16:
+        # with few relevant candidates counting who beats them is cheaper than sorting every row;
+        # a tie counts against the document, so a fit cannot gain by collapsing scores
+        target = np.take_along_axis( scores , np.broadcast_to( cols , scores.shape[:-1] + cols.shape[-1:] ) , axis=-1 )
+        ranks = ( scores[ ... , None , : ] >= target[ ... , None ] ).sum( axis=-1 ).astype( np.float64 )
+        ranks = np.sort( np.where( found , ranks , np.inf ) , axis=-1 )
+        ap = ( np.arange( 1 , width + 1 ) / ranks ).sum( axis=-1 ) / np.maximum( n_relevant , 1 )
+    else:
+        # ties are rare in fused scores, the unstable sort is several times faster here
+        order = np.argsort( -scores , axis=-1 )
+        rel = np.take_along_axis( np.broadcast_to( relevant , scores.shape ) , order , axis=-1 )
+        ap = averagePrecision( rel , n_relevant )
+    return ap.mean( axis=-1 )
+
+
+def _blockSize( relevant , cols , max_cells ):
+    cells = relevant.size * ( cols.shape[-1] if cols.shape[-1] <= 16 else 1 )
+    return max( 1 , max_cells // max( cells , 1 ) )
+
+
+def sweepAlpha( matrix , alphas , relevant , n_relevant , max_cells=2 ** 24 ):
+    # aMAP of every alpha, alphas evaluated in blocks of ( alphas , Q , D ) arrays
+    alphas = np.atleast_1d( np.asarray( alphas , dtype=np.float64 ) )
+    cols , found = _relevantColumns( relevant )
+    block = _blockSize( relevant , cols , max_cells )
+    amap = np.zeros( len( alphas ) , dtype=np.float64 )
+    for start in range( 0 , len( alphas ) , block ):
+        amap[ start : start + block ] = _meanAP( matrix.fuse( alphas[ start : start + block ] ) , relevant , n_relevant , cols , found )
+    return amap
+
+
+def sweepWeights( features , mask , weights , relevant , n_relevant , max_cells=2 ** 24 ):
+    # MAP of every ( K , F ) weight vector over ( Q , D , F ) features, in blocks of ( K , Q , D ) scores
+    weights = np.atleast_2d( np.asarray( weights , dtype=np.float64 ) )
+    cols , found = _relevantColumns( relevant )
+    block = _blockSize( relevant , cols , max_cells )
+    result = np.zeros( len( weights ) , dtype=np.float64 )
+    for start in range( 0 , len( weights ) , block ):
+        scores = np.einsum( "qdf,kf->kqd" , features , weights[ start : start + block ] )
+        result[ start : start + block ] = _meanAP( np.where( mask , scores , -np.inf ) , relevant , n_relevant , cols , found )
+    return result
+
+
+def alphaWeights( alphas ):
+    # the weight vectors of bert + alpha * first
+    alphas = np.atleast_1d( np.asarray( alphas , dtype=np.float64 ) )
+    weights = np.zeros( ( len( alphas ) , len( FEATURES ) ) )
+    weights[ : , FEATURES.index( "bert" ) ] = 1.0
+    weights[ : , FEATURES.index( "first" ) ] = alphas
+    return weights
+
+
+def coordinateAscent( features , mask , relevant , n_relevant , init=None , restarts=5 , rounds=20 , seed=0 , tol=1e-6 ):
+    # linear fusion fitted on MAP itself ( Metzler & Croft ): move one weight at a time to the best of
+    # all its candidate steps, evaluated together; MAP only depends on the direction of the weights,
+    # so they are kept at unit L1 norm. Random restarts, the first one from init.
+    n_features = features.shape[-1]
+    steps = 2.0 ** np.arange( -8 , 3 )
+    steps = np.concatenate( [ [ 0.0 ] , steps , -steps ] )
+    rng = np.random.default_rng( seed )
+    best_map , best_weights = -1.0 , None
+    for restart in range( restarts ):
+        if restart == 0 and init is not None:
+            weights = np.asarray( init , dtype=np.float64 )
+        else:
+            weights = rng.uniform( -1.0 , 1.0 , n_features ) if restart else np.eye( n_features )[0]
+        weights = weights / max( np.abs( weights ).sum() , 1e-12 )
+        current = sweepWeights( features , mask , weights , relevant , n_relevant )[0]
+        for _ in range( rounds ):
+            start = current
+            for f in range( n_features ):
+                candidates = np.repeat( weights[ None ] , len( steps ) , axis=0 )
+                candidates[ : , f ] += steps
+                candidates /= np.maximum( np.abs( candidates ).sum( axis=-1 , keepdims=True ) , 1e-12 )
+                result = sweepWeights( features , mask , candidates , relevant , n_relevant )
+                i = int( np.argmax( result ) )
+                if result[ i ] > current + tol:
+                    current , weights = float( result[ i ] ) , candidates[ i ]
+            if current <= start + tol:
+                break
+        if current > best_map:
+            best_map , best_weights = float( current ) , weights
+    return best_map , best_weights
+
+
+def crossValidate( features , mask , relevant , n_relevant , fit , folds=5 , seed=0 ):
+    # MAP of held-out queries, each fold scored with the weights fit( features , mask , relevant , n_relevant )
+    # returned on the other folds; the mean over all queries
+    fold = np.random.default_rng( seed ).permutation( len( features ) ) % folds
+    total = 0.0
+    for k in range( folds ):
+        train , test = fold != k , fold == k
+        if not test.any():
+            continue
+        weights = fit( features[ train ] , mask[ train ] , relevant[ train ] , n_relevant[ train ] )
+        total += sweepWeights( features[ test ] , mask[ test ] , weights , relevant[ test ] , n_relevant[ test ] )[0] * test.sum()
+    return total / max( len( features ) , 1 )
+
+
+def goldenSection( matrix , relevant , n_relevant , lo , hi , tol=1e-3 ):
+    # aMAP is piecewise constant in alpha, so this assumes one peak; use it to refine a grid result
+    ratio = ( np.sqrt( 5 ) - 1 ) / 2
+    a , b = lo , hi
+    c , d = b - ratio * ( b - a ) , a + ratio * ( b - a )
+    fc , fd = sweepAlpha( matrix , [ c , d ] , relevant , n_relevant )
+    while b - a > tol:
+        if fc >= fd:
+            b , d , fd = d , c , fc
+            c = b - ratio * ( b - a )
+            fc = sweepAlpha( matrix , c , relevant , n_relevant )[0]
+        else:
+            a , c , fc = c , d , fd
+            d = a + ratio * ( b - a )
+            fd = sweepAlpha( matrix , d , relevant , n_relevant )[0]
+    return ( fc , c ) if fc >= fd else ( fd , d )
+
+
+def coarseToFine( matrix , relevant , n_relevant , lo , hi , points=21 , levels=4 ):
+    # grid search, then a finer grid around the best point, levels times
+    best_amap , best_alpha = -1.0 , lo
+    for level in range( levels ):
+        alphas = np.linspace( lo , hi , points )
+        amap = sweepAlpha( matrix , alphas , relevant , n_relevant )
+        i = int( np.argmax( amap ) )
+        if amap[ i ] > best_amap:
+            best_amap , best_alpha = float( amap[ i ] ) , float( alphas[ i ] )
+        step = alphas[1] - alphas[0]
+        lo , hi = max( best_alpha - step , lo ) , min( best_alpha + step , hi )
+    return best_amap , best_alpha
+
+
+def cascadeReport( matrix , alpha , relevant , n_relevant , cutoffs , list_lengths ):
+    # MAP when BERT scores only the first-stage top k of every list, against the pairs it skips
+    # list_lengths : ( Q , ) length of each query's full first-stage list, the pairs of a full rerank
+    # one ( cutoff , MAP , pairs scored , fraction of pairs saved ) per cutoff
+    fused = matrix.fuse( alpha )
+    total = int( np.sum( list_lengths ) )
+    report = []
+    for top_k in cutoffs:
+        scores = matrix.cascade( fused , top_k )
+        order  = np.argsort( -scores , axis=-1 , kind="stable" )
+        rel    = np.take_along_axis( relevant , order , axis=-1 )
+        pairs  = int( np.minimum( list_lengths , top_k ).sum() )
+        report.append( ( top_k , float( averagePrecision( rel , n_relevant ).mean() ) , pairs , 1.0 - pairs / max( total , 1 ) ) )
+    return report
+
+
+def writeRanking( path , matrix , scores , que_top_dict=None , top_k=None ):
+    # the query_id,ranked_doc_ids csv, rewritten on every run
+    # with que_top_dict the documents BERT never scored ( cascade ) follow in first-stage order,
+    # and queries with no scored document at all keep their first-stage list
+    ranked = matrix.rankedLists( scores , top_k )
+    with open( path , "w" ) as writefile:
+        writefile.write( "query_id,ranked_doc_ids\n" )
+        for query_name in ( que_top_dict.keys() if que_top_dict is not None else ranked.keys() ):
+            doc_list = ranked.get( query_name , [] )
+            if que_top_dict is not None:
+                seen = set( doc_list )
+                doc_list = doc_list + [ doc_name for doc_name in que_top_dict[ query_name ] if doc_name not in seen ]
+            writefile.write( ",".join( [ str( query_name ) , " ".join( doc_list[ :top_k ] ) ] ) + "\n" )
+    return ranked
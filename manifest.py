@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import os , json , shutil , hashlib
+from contextlib import contextmanager
+
+
+## content-hashed manifest of the artifacts in save/
+# every stage of preprocessing_bert.py is keyed by the sha256 of its input files, its parameters
+# and a version bumped whenever the stage's code changes what it writes; a stage whose key and
+# outputs are unchanged is skipped
+# file hashes are cached by ( size , mtime ), so an unchanged corpus is not read again to be hashed
+
+
+def sha256File( path , chunk_size=1 << 20 ):
+    digest = hashlib.sha256()
+    with open( path , "rb" ) as readfile:
+        for chunk in iter( lambda: readfile.read( chunk_size ) , b"" ):
+            digest.update( chunk )
+    return digest.hexdigest()
+
+
+@contextmanager
+def atomicOutput( path ):
+    # yields a temporary path beside path ( same extension, so writers still know the format ),
+    # moved over path only when the block finishes
+    root , ext = os.path.splitext( path.rstrip( "/" ) )
+    tmp = root + ".tmp" + ext
+    if os.path.isdir( tmp ):
+        shutil.rmtree( tmp )
+    elif os.path.exists( tmp ):
+        os.remove( tmp )
+    yield tmp
+    if os.path.isdir( path ):
+        shutil.rmtree( path )
+    os.replace( tmp , path.rstrip( "/" ) )
+
+
+class Manifest:
+
+    def __init__( self , path ):
+        self.path = path
+        self.data = { "stages" : {} , "files" : {} }
+        if os.path.exists( path ):
+            with open( path ) as readfile:
+                self.data = json.load( readfile )
+
+    def fileHash( self , path ):
+        stat = os.stat( path )
+        cached = self.data[ "files" ].get( path )
+        if cached is None or cached[ "size" ] != stat.st_size or cached[ "mtime_ns" ] != stat.st_mtime_ns:
+            cached = { "size" : stat.st_size , "mtime_ns" : stat.st_mtime_ns , "sha256" : sha256File( path ) }
+            self.data[ "files" ][ path ] = cached
+        return cached[ "sha256" ]
+
+    def key( self , inputs , params , version ):
+        # inputs : files the stage reads, params : json-able settings that change its outputs
+        description = { "version" : version , "inputs" : { path : self.fileHash( path ) for path in sorted( inputs ) } , "params" : params }
+        return hashlib.sha256( json.dumps( description , sort_keys=True ).encode( "utf-8" ) ).hexdigest()
+
+    def stale( self , stage , inputs , params , outputs , version=1 ):
+        entry = self.data[ "stages" ].get( stage )
+        if entry is None or entry[ "key" ] != self.key( inputs , params , version ):
+            return True
+        return not all( os.path.exists( path ) for path in outputs )
+
+    def param( self , stage , name , default=None ):
+        # a parameter the stage was last built with, so later scripts follow it
+        return self.data[ "stages" ].get( stage , {} ).get( "params" , {} ).get( name , default )
+
+    def build( self , stage , inputs , params , outputs , write , force=False , version=1 ):
+        # for files the scripts derive on demand: write() them when stale ( or force ) and record the stage;
+        # True when they were written
+        if not force and not self.stale( stage , inputs , params , outputs , version ):
+            return False
+        write()
+        self.record( stage , inputs , params , outputs , version )
+        return True
+
+    def record( self , stage , inputs , params , outputs , version=1 ):
+        self.data[ "stages" ][ stage ] = { "key" : self.key( inputs , params , version ) , "params" : params , "inputs" : sorted( inputs ) , "outputs" : sorted( outputs ) }
+        self.save()
+
+    def save( self ):
+        with atomicOutput( self.path ) as tmp:
+            with open( tmp , "w" ) as writefile:
+                json.dump( self.data , writefile , indent=2 , sort_keys=True )
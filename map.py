@@ -1,9 +1,13 @@
 #!/usr/bin/env python
 # coding: utf-8
 
-import csv , pickle
+import os , time , pickle , argparse
 import numpy as np
 
+from artifacts import findExampleFile, readChoiceRows, readLogits
+from fusion import FEATURES, alignScores, alphaWeights, cascadeReport, coarseToFine, coordinateAscent, crossValidate, goldenSection, sweepAlpha, sweepWeights, writeRanking
+from scorestore import ScoreStore, missingRows
+
 
 def pickleStore( savethings , filename ):
     dbfile = open( filename , 'wb' )
@@ -18,57 +22,85 @@ def pickleOpen( filename ):
     return p
 
 
-def softmax( vector ):
-	e = np.exp( vector )
-	return e / e.sum()
-
-
-def MAP( rel , ans , q ):
-    t = 0
-    for i in range( 0 , q ):
-        s , sss = 0 , {}
-        # 這行是 revelant set
-        a = rel.split()
-        # 這行是 answer set
-        b = set( ans.split() )
-        for index , doc in enumerate( a ):
-            if doc in b:
-                s += 1
-                sss [ s ] = s / ( index + 1 )
-        t += sum( sss.values() ) / len( b )
-    return round( ( t / q ) * 10000.0  ) / 10000
-
-
-def Train_alpha( start , stop , interval ):
-    
-    que_top_dict = pickleOpen( dic_save + "train_que_top_dict.pkl" )
-    bestalpha = 0
-    bestamap  = 0
-    for alpha in np.arange( start + interval , stop + interval , interval ):
-        new  = {}
-        for query_name , d_v in que_top_dict.items():
-            if query_name in d_list:
-                if query_name not in new.keys():
-                    new[ query_name ] = {}
-                for doc_name , softmax_score in d_v.items():
-                    new[ query_name ][ doc_name ] = np.log2( save[ query_name ][ doc_name ] ) + alpha * np.log2( softmax_score )
-        pickleStore( new , dic_rerank + "train_ques_docs_alpha_reranking-{}.pkl".format( alpha ) )
-
-        map_list = []
-        for query_name , d_v in new.items():
-            row = [ str( query_name ) , que_pos_dict[ query_name ] , " ".join( sorted( d_v , key=d_v.get , reverse=True ) ) ]
-            map = MAP( row[2] , row[1] , len( row[2].split() ) )
-            print( "{0} : {1}".format( query_name , map ) )
-        aMAP = sum( map_list ) / len( new )
-        print( "Total aMAP : {0}, for alpha {1}".format( aMAP , alpha ) )
-        if aMAP > bestamap:
-            bestamap = aMAP
-            bestalpha = alpha
+def storedLogits( rows , name ):
+    # logits of rows by ( query , document ) from the score store, every pair must have been scored
+    logits = score_store.lookup( scorer , rows )
+    missing = missingRows( logits , rows )
+    if missing.any():
+        raise SystemExit( "{0} of {1} {2} rows have pairs {3} never scored".format( int( missing.sum() ) , len( rows ) , name , args.checkpoint ) )
+    return np.nan_to_num( logits , nan=0.0 )
+
+
+def Train_alpha( start , stop , interval , search="grid" ):
+
+    relevant , n_relevant = alpha_matrix.relevant( que_pos_dict )
+    if search == "golden":
+        bestamap , bestalpha = goldenSection( alpha_matrix , relevant , n_relevant , start , stop )
+    elif search == "coarse":
+        bestamap , bestalpha = coarseToFine( alpha_matrix , relevant , n_relevant , start , stop )
+    else:
+        alphas = np.arange( start + interval , stop + interval , interval )
+        amap = sweepAlpha( alpha_matrix , alphas , relevant , n_relevant )
+        for alpha , aMAP in zip( alphas , amap ):
+            print( "Total aMAP : {0}, for alpha {1}".format( aMAP , alpha ) )
+        bestamap , bestalpha = float( amap.max() ) , float( alphas[ np.argmax( amap ) ] )
+
+    # intermediate rerank files only on request
+    if dump_rerank:
+        if not os.path.exists( dic_rerank ):
+            os.makedirs( dic_rerank )
+        for alpha in np.arange( start + interval , stop + interval , interval ):
+            new = alpha_matrix.rerankDict( alpha_matrix.fuse( alpha ) )
+            pickleStore( new , dic_rerank + "train_ques_docs_alpha_reranking-{}.pkl".format( alpha ) )
     return bestamap , bestalpha
 
 
+def Train_fusion( bestalpha , folds=5 ):
+    # learned weights over every fusion feature, against the alpha grid on the same queries
+    features = alpha_matrix.features()
+    mask = alpha_matrix.mask
+    relevant , n_relevant = alpha_matrix.relevant( que_pos_dict )
+    grid = alphaWeights( np.arange( 0.01 , 5.01 , 0.01 ) )
+
+    start = time.time()
+    sweepWeights( features , mask , grid , relevant , n_relevant )
+    print( "Weight vectors evaluated per second: {0:.0f}".format( len( grid ) / max( time.time() - start , 1e-9 ) ) )
+
+    def fitGrid( features , mask , relevant , n_relevant ):
+        return grid[ np.argmax( sweepWeights( features , mask , grid , relevant , n_relevant ) ) ]
+
+    def fitLearned( features , mask , relevant , n_relevant ):
+        return coordinateAscent( features , mask , relevant , n_relevant , init=fitGrid( features , mask , relevant , n_relevant ) )[1]
+
+    start = time.time()
+    learned_map , weights = coordinateAscent( features , mask , relevant , n_relevant , init=alphaWeights( bestalpha )[0] )
+    fit_time = time.time() - start
+    grid_map = sweepWeights( features , mask , alphaWeights( bestalpha ) , relevant , n_relevant )[0]
+    print( "Learned weights: {0}".format( ", ".join( "{0} {1:.4f}".format( name , w ) for name , w in zip( FEATURES , weights ) ) ) )
+    print( "Alpha grid  aMAP: {0:.4f}, {1}-fold held-out {2:.4f}".format( grid_map , folds , crossValidate( features , mask , relevant , n_relevant , fitGrid , folds ) ) )
+    print( "Learned     aMAP: {0:.4f}, {1}-fold held-out {2:.4f}, fitted in {3:.2f} s".format( learned_map , folds , crossValidate( features , mask , relevant , n_relevant , fitLearned , folds ) , fit_time ) )
+    return weights
+
+
 if __name__ == "__main__":
 
+    parser = argparse.ArgumentParser()
+    parser.add_argument( "--search" , default="grid" , choices=[ "grid" , "golden" , "coarse" ] , help="how to search alpha in [0, 5]" )
+    parser.add_argument( "--dump_rerank" , action="store_true" , help="pickle the reranking of every grid alpha to save/rerank/" )
+    parser.add_argument( "--cutoffs" , type=int , nargs="+" , default=[ 0 , 20 , 40 , 100 , 200 , 500 , 1000 ] , help="first-stage depths BERT reranks in the cascade report" )
+    parser.add_argument( "--cascade_top_k" , type=int , default=None , help="the test queries were predicted on their first-stage top k only" )
+    parser.add_argument( "--fusion" , default="alpha" , choices=[ "alpha" , "learned" ] , help="rank the test queries with the best alpha, or with weights learned over every fusion feature" )
+    parser.add_argument( "--checkpoint" , default=None , help="look the logits of this model ( or engine ) directory up in the score store by ( query , document ), instead of reading the trainer_*_result.npy files" )
+    parser.add_argument( "--score_store" , default=None , help="score store of --checkpoint, save/scores.sqlite by default" )
+    parser.add_argument( "--max_seq_length" , type=int , default=None , help="the --max_seq_length --checkpoint scored with, its tokenizer's maximum by default as in bert.py and predict.py" )
+    parser.add_argument( "--no_repeat_query" , action="store_true" , help="--checkpoint scored with --no_repeat_query" )
+    parser.add_argument( "--precision" , default="fp32" , choices=[ "fp32" , "fp16" ] , help="precision --checkpoint scored in, fp16 for bert.py --fp16" )
+    parser.add_argument( "--passages" , default=None , choices=[ "maxp" , "firstp" , "sump" ] , help="fuse with the document scores aggregated from passage scores ( predict.py --scoring passage ) instead of the multiple choice logits" )
+    args = parser.parse_args()
+    if args.passages is not None and args.checkpoint is not None:
+        parser.error( "--passages reads the aggregated scores predict.py wrote, the score store holds passage logits" )
+    dump_rerank = args.dump_rerank
+
     dic_sources = 'ntust-ir2020-homework6/'
     dic_save    = dic_sources + 'save/'
     dic_rerank  = dic_save + 'rerank/'
@@ -76,57 +108,53 @@ if __name__ == "__main__":
     ## reproduce alpha ranking
     d_list = pickleOpen( dic_save + "alpha_querys_docs_list.pkl" )
     que_pos_dict = pickleOpen( dic_save + "train_que_pos_dict.pkl" )
-    trainer_alpha_result = pickleOpen( dic_save + "trainer_alpha_result.pkl" )
-    save = {}
-    tmp  = {}
-    pre_result = trainer_alpha_result[0]
-    with open( dic_save + 'train_for_alpha_train.csv' , newline='' ) as csvfile:
-        spamreader = csv.reader( csvfile , delimiter=',' )
-        next(spamreader)
-        for c , row in enumerate( spamreader ):
-            if row[0] not in save.keys():
-                save[ row[0] ] = {}
-            for tup in zip( row[2].split() , pre_result[c].tolist() ):
-                save[ row[0] ][ tup[0] ] = tup[1]
-        # sort
-        save = { query_name : dict( sorted( d_v.items(), key=lambda item: item[1] , reverse=True ) ) for query_name , d_v in save.items() }
-        # compute softmax
-        for query_name , d_v in save.items():
-            tmp[ query_name ] = softmax( np.array( list( save[ query_name ].values() ) , dtype=np.float64 ) ).tolist()
-        save = { query_name : dict( zip( list( save[ query_name ].keys() ) , tmp[ query_name ] ) ) for query_name in save.keys() }
-
-    bestamap , bestalpha = Train_alpha( 0 , 5 , 0.01 )
+    # logits with the rows they belong to, memory-mapped; or by key from the score store
+    if args.checkpoint is not None:
+        rows = readChoiceRows( findExampleFile( dic_save , "train_for_alpha_train" ) )
+        score_store = ScoreStore( args.score_store or dic_save + "scores.sqlite" )
+        # the scorer the writers registered for these settings, logits of other settings are not mixed in
+        max_length = args.max_seq_length
+        if max_length is None:
+            from transformers import AutoTokenizer
+            max_length = AutoTokenizer.from_pretrained( args.checkpoint ).model_max_length
+        scorer = score_store.scorer( args.checkpoint , create=False , max_length=max_length , repeat_query=not args.no_repeat_query , precision=args.precision )
+        if scorer is None:
+            raise SystemExit( "{0} has no scores in the score store at max_seq_length {1}, repeat_query {2}, precision {3}".format( args.checkpoint , max_length , not args.no_repeat_query , args.precision ) )
+        pre_result = storedLogits( rows , "alpha" )
+    else:
+        rows , pre_result = readLogits( dic_save + ( "trainer_alpha_result.npy" if args.passages is None else "alpha_{}_scores.npy".format( args.passages ) ) )
+    alpha_matrix = alignScores( rows , pre_result , pickleOpen( dic_save + "train_que_top_dict.pkl" ) , set( d_list ) )
+
+    bestamap , bestalpha = Train_alpha( 0 , 5 , 0.01 , args.search )
     print( "Best aMAP: {0}, Best Alpha: {1}".format( bestamap , bestalpha ) )
-
-    # recalculate new rereanking score again
-    new  = {}
-    save = {}
-    with open( dic_save + 'test.csv' , newline='' ) as csvfile:
-        spamreader = csv.reader( csvfile , delimiter=',' )
-        next(spamreader)
-        for c , row in enumerate( spamreader ):
-            if row[0] not in save.keys():
-                save[ row[0] ] = {}
-            for tup in zip( row[2].split() , pre_result[c].tolist() ):
-                save[ row[0] ][ tup[0] ] = tup[1]
-        # sort
-        save = { query_name : dict( sorted( d_v.items(), key=lambda item: item[1] , reverse=True ) ) for query_name , d_v in save.items() }
-        # compute softmax
-        for query_name , d_v in save.items():
-            tmp[ query_name ] = softmax( np.array( list( save[ query_name ].values() ) , dtype=np.float64 ) ).tolist()
-        save = { query_name : dict( zip( list( save[ query_name ].keys() ) , tmp[ query_name ] ) ) for query_name in save.keys() }
-
-    que_top_dict = pickleOpen( dic_save + "train_que_top_dict.pkl" )
-    for query_name , d_v in que_top_dict.items():
-        if query_name not in new.keys():
-            new[ query_name ] = {}
-        for doc_name , softmax_score in d_v.items():
-            new[ query_name ][ doc_name ] = np.log2( save[ query_name ][ doc_name ] ) + bestalpha * np.log2( softmax_score )
-    pickleStore( new , dic_save + "train_ques_docs_best_rerank.pkl" )
-
-    # save result
-    with open( dic_save + "test_ques_docs_best_rerank.csv" , "a" ) as writefile:
-        writefile.write( "query_id,ranked_doc_ids\n" )
-        for query_name , d_v in new.items():
-            append = ",".join( [ str( query_name ) , " ".join( sorted( d_v , key=d_v.get , reverse=True ) ) ] )
-            writefile.write( append + "\n" )
+    if args.fusion == "learned":
+        weights = Train_fusion( bestalpha )
+
+    ## cascade report: MAP when BERT reranks only the first-stage top k, on the full lists of the alpha queries
+    # needs their pointwise scores: predict.py --scoring pointwise --queries alpha
+    if os.path.exists( dic_save + "alpha_pointwise_scores.npy" ):
+        train_que_top_dict = pickleOpen( dic_save + "train_que_top_dict.pkl" )
+        full_rows , full_logits = readLogits( dic_save + "alpha_pointwise_scores.npy" )
+        full_matrix = alignScores( full_rows , full_logits , train_que_top_dict )
+        relevant , n_relevant = full_matrix.relevant( que_pos_dict )
+        list_lengths = np.array( [ len( train_que_top_dict[ query_name ] ) for query_name in full_matrix.queries ] )
+        for top_k , cMAP , pairs , saved in cascadeReport( full_matrix , bestalpha , relevant , n_relevant , args.cutoffs , list_lengths ):
+            print( "Cascade top {0}: MAP {1:.4f}, {2} pairs scored, {3:.1%} of the BERT compute saved".format( top_k , cMAP , pairs , saved ) )
+    else:
+        print( "No cascade report: score the alpha queries with predict.py --scoring pointwise --queries alpha" )
+
+    ## rerank the test queries with the best alpha
+    cascade_suffix = "" if args.cascade_top_k is None else "-top{}".format( args.cascade_top_k )
+    que_top_dict = pickleOpen( dic_save + "test_que_top_dict.pkl" )
+    if args.checkpoint is not None:
+        rows = readChoiceRows( findExampleFile( dic_save , "test" + cascade_suffix ) )
+        test_logits = storedLogits( rows , "test" )
+    else:
+        rows , test_logits = readLogits( dic_save + ( "trainer_test_result{}.npy" if args.passages is None else "test_" + args.passages + "_scores{}.npy" ).format( cascade_suffix ) )
+    test_matrix = alignScores( rows , test_logits , que_top_dict )
+    if args.fusion == "learned":
+        scores = np.where( test_matrix.mask , test_matrix.features() @ weights , -np.inf )
+    else:
+        scores = test_matrix.fuse( bestalpha )
+    pickleStore( test_matrix.rerankDict( scores ) , dic_save + "test_ques_docs_best_rerank.pkl" )
+    writeRanking( dic_save + "test_ques_docs_best_rerank.csv" , test_matrix , scores , que_top_dict )
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import numpy as np
+
+
+## softmax in log space, shifted by the maximum so that no exp overflows
+# -inf entries ( padding ) take no share, a group of nothing but -inf stays -inf
+# base=2 gives log2 softmax, the unit fusion works in
+# ragged groups ( e.g. the candidates of every query ) are segments of one flat array:
+# offsets holds the start of every segment, the last one runs to the end of values
+
+
+def _shift( top ):
+    return np.where( np.isfinite( top ) , top , 0.0 )
+
+
+def logSoftmax( x , axis=-1 , base=None ):
+    x = np.asarray( x , dtype=np.float64 )
+    top = _shift( x.max( axis=axis , keepdims=True ) )
+    with np.errstate( divide="ignore" , invalid="ignore" ):
+        result = x - top - np.log( np.exp( x - top ).sum( axis=axis , keepdims=True ) )
+    result = np.where( x == -np.inf , -np.inf , result )
+    return result / np.log( base ) if base is not None else result
+
+
+def softmax( x , axis=-1 ):
+    # probabilities from the log softmax: the largest entry of a group is never below 1 / n
+    return np.exp( logSoftmax( x , axis ) )
+
+
+def segmentLengths( offsets , size ):
+    return np.diff( np.append( np.asarray( offsets , dtype=np.int64 ) , size ) )
+
+
+def segmentReduce( ufunc , values , offsets , empty ):
+    # ufunc.reduceat over every segment; reduceat cannot express an empty segment, those get empty
+    lengths = segmentLengths( offsets , len( values ) )
+    result = np.full( len( lengths ) , empty , dtype=np.float64 )
+    nonempty = lengths > 0
+    if nonempty.any():
+        result[ nonempty ] = ufunc.reduceat( values , np.asarray( offsets )[ nonempty ] )
+    return result
+
+
+def segmentLogSumExp( values , offsets ):
+    values = np.asarray( values , dtype=np.float64 )
+    lengths = segmentLengths( offsets , len( values ) )
+    top = _shift( segmentReduce( np.maximum , values , offsets , -np.inf ) )
+    with np.errstate( divide="ignore" ):
+        return top + np.log( segmentReduce( np.add , np.exp( values - np.repeat( top , lengths ) ) , offsets , 0.0 ) )
+
+
+def segmentLogSoftmax( values , offsets , base=None ):
+    # log softmax of every segment in one pass, same layout as values
+    values = np.asarray( values , dtype=np.float64 )
+    lengths = segmentLengths( offsets , len( values ) )
+    with np.errstate( invalid="ignore" ):
+        result = values - np.repeat( segmentLogSumExp( values , offsets ) , lengths )
+    result = np.where( values == -np.inf , -np.inf , result )
+    return result / np.log( base ) if base is not None else result
@@ -0,0 +1,500 @@
+# coding=utf-8
+"""
+Sharded, resumable scoring of the test rows with a fine-tuned multiple choice model.
+
+The rows are cut into shards of --shard_size. Every finished shard is written to --shard_dir as soon as it is
+scored, a restarted run skips the shards already on disk, and --num_workers CPU processes score shards side by
+side. When every shard is done they are merged into the trainer_test_result.npy that map.py reads: float32 logits,
+and beside them in trainer_test_result.rows.npz the query and documents of every row.
+
+With --scoring pointwise every (query, document) pair of the first-stage lists is scored on its own, as a row with a
+single choice: the same encoder and classifier head, no grouping with 3 other documents, so the scores of one query
+are comparable. The result has one row per pair, in test_pointwise_scores.npy.
+
+With --scoring passage the documents are scored by their passages, the overlapping windows preprocessing_bert.py
+--passage_words stores in save/passage_store: every passage of every candidate is a single-choice row, best packed
+into large batches with --max_tokens_per_batch, and --aggregation folds the passage logits of a document into its
+score, the max (maxp), the first passage alone (firstp, the only one scored) or the sum (sump). The result has one
+row per document, in test_maxp_scores.npy and the like; map.py --passages fuses with it.
+
+--top_k cascades: only the first-stage head of each list goes through BERT, and map.py ranks the rest of the list
+below it in first-stage order. --queries alpha scores the full lists of the labelled alpha queries pointwise, which
+is what map.py needs to report MAP against the compute saved at each cutoff.
+
+Every logit also goes to a SQLite store keyed by (checkpoint, query, document), save/scores.sqlite. A row whose
+pairs are all in it is not scored again, whichever file or order it comes in, and map.py --checkpoint looks the
+scores up by key.
+
+--engine scores with a TorchScript or ONNX engine exported by engine.py. With --reference_file, the logits of an
+earlier fp32 run over the same pairs, the merged result is checked against it before anything is written: BERT-only
+MAP of the labelled queries among the rows (the alpha queries) may differ by at most --map_tolerance, and every logit
+by at most --logit_tolerance when it is given. The test queries have no answers, checking them needs --logit_tolerance.
+"""
+
+import json
+import logging
+import os
+import pickle
+import sys
+from dataclasses import dataclass, field
+from multiprocessing import get_context
+from typing import Optional
+
+import numpy as np
+import torch
+from transformers import AutoModelForMultipleChoice, AutoTokenizer, HfArgumentParser
+
+from artifacts import ExampleWriter, choiceList, exampleFile, findExampleFile, loadExamples, readChoiceRows, readLogits, writeLogits, writeTopRows
+from bert import DataCollatorForMultipleChoice, TokenBudgetBatchSampler
+from docstore import openDocStore, passageDoc, passageNames
+from engine import loadEngine
+from fusion import alignScores, sweepAlpha
+from manifest import Manifest
+from scorestore import ScoreStore, missingRows
+from tokencache import buildTokenCache, encodeChoices, openTokenCache, tokenCachePath
+
+
+logger = logging.getLogger(__name__)
+
+dic_save = 'save/'
+
+
+@dataclass
+class PredictArguments:
+    """
+    Arguments pertaining to which model scores which rows, and how the work is cut.
+    """
+
+    model_name_or_path: str = field(metadata={"help": "Fine-tuned model directory (the output_dir of bert.py)"})
+    scoring: str = field(
+        default="choice",
+        metadata={
+            "help": "choice: score the multiple choice rows of the test file. "
+            "pointwise: score every (query, document) pair of the first-stage lists on its own. "
+            "passage: score every passage of those documents on its own and aggregate them per document."
+        },
+    )
+    aggregation: str = field(
+        default="maxp", metadata={"help": "Document score from its passage scores: maxp, firstp or sump"}
+    )
+    max_passages: Optional[int] = field(
+        default=None, metadata={"help": "Score at most this many passages of a document, from its start"}
+    )
+    top_k: Optional[int] = field(
+        default=None,
+        metadata={
+            "help": "Score just the first-stage top k documents of each query, rounded up to whole rows "
+            "in choice mode"
+        },
+    )
+    group_size: Optional[int] = field(
+        default=None,
+        metadata={
+            "help": "Choice mode: score the test queries in rows of this many documents (e.g. 16, fewer forward "
+            "passes per document) instead of the rows preprocessing wrote"
+        },
+    )
+    queries: str = field(
+        default="test",
+        metadata={
+            "help": "test, alpha: the labelled alpha queries of the training set, or train: every training query, "
+            "whose pointwise scores preprocessing_bert.py --mine_scores re-mines negatives with (not in choice mode)"
+        },
+    )
+    test_file: Optional[str] = field(
+        default=None, metadata={"help": "Rows to score, defaults to the test file preprocessing wrote in save/"}
+    )
+    shard_dir: Optional[str] = field(
+        default=None, metadata={"help": "Where finished shards are kept, save/test_<scoring>_shards/ by default"}
+    )
+    output_file: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "Merged logits of every row, save/trainer_test_result.npy, or save/test_pointwise_scores.npy in "
+            "pointwise mode; the rows go to the .rows.npz beside it"
+        },
+    )
+    shard_size: int = field(default=2000, metadata={"help": "Rows per shard"})
+    batch_size: int = field(default=32, metadata={"help": "Rows per forward pass"})
+    max_tokens_per_batch: Optional[int] = field(
+        default=None,
+        metadata={"help": "If set, batch rows of similar length under this many tokens instead of batch_size rows"},
+    )
+    num_workers: int = field(default=1, metadata={"help": "Processes scoring shards in parallel"})
+    threads_per_worker: Optional[int] = field(
+        default=None, metadata={"help": "torch intra-op threads of each process, all cores by default"}
+    )
+    max_seq_length: Optional[int] = field(
+        default=None, metadata={"help": "Same value as in training, the model maximum by default"}
+    )
+    repeat_query: bool = field(
+        default=True, metadata={"help": "Whether the second sentence repeats the query, as set in training"}
+    )
+    engine: Optional[str] = field(
+        default=None, metadata={"help": "Directory of an engine exported by engine.py, used instead of the model"}
+    )
+    reference_file: Optional[str] = field(
+        default=None, metadata={"help": "output_file of an fp32 run over the same rows, to check the result against"}
+    )
+    score_store: Optional[str] = field(
+        default=dic_save + "scores.sqlite",
+        metadata={"help": "SQLite store of logits keyed by (checkpoint, query, document), empty to score every row"},
+    )
+    map_tolerance: float = field(default=0.01, metadata={"help": "Largest MAP difference allowed by the check"})
+    logit_tolerance: Optional[float] = field(
+        default=None,
+        metadata={
+            "help": "Largest logit difference allowed by the check; required with --queries test, which has no "
+            "answers to compare MAP on"
+        },
+    )
+    device: str = field(default="cpu", metadata={"help": "torch device of a single-process run"})
+    overwrite: bool = field(default=False, metadata={"help": "Drop the shards of an earlier run"})
+
+
+# model, tokenizer and rows of this process, loaded once by _initWorker
+_worker = {}
+
+
+def _initWorker(args, scorer=None):
+    if args.threads_per_worker is not None:
+        torch.set_num_threads(args.threads_per_worker)
+    tokenizer = AutoTokenizer.from_pretrained(args.model_name_or_path)
+    if args.engine is not None:
+        model = loadEngine(args.engine, args.threads_per_worker)
+    else:
+        model = AutoModelForMultipleChoice.from_pretrained(args.model_name_or_path)
+        model.to(args.device if args.num_workers <= 1 else "cpu")
+        model.eval()
+    max_length = args.max_seq_length if args.max_seq_length is not None else tokenizer.model_max_length
+    _worker.update(
+        args=args,
+        tokenizer=tokenizer,
+        model=model,
+        max_length=max_length,
+        rows=loadExamples({"test": args.test_file})["test"],
+        token_cache=openTokenCache(tokenCachePath(dic_save, tokenizer, max_length, args.scoring == "passage")),
+        missing_doc_ids=tokenizer(" None ", add_special_tokens=False)["input_ids"],
+        collator=DataCollatorForMultipleChoice(tokenizer=tokenizer),
+        scorer=scorer,
+    )
+    if scorer is not None:
+        # workers only read the store, the main process writes the merged logits
+        _worker.update(store=ScoreStore(args.score_store), choice_rows=readChoiceRows(args.test_file))
+
+
+def firstStage(dic_save, queries="test"):
+    """Query texts and first-stage lists of the test queries, of the training queries, or of their alpha queries."""
+    split = "test" if queries == "test" else "train"
+    with open(dic_save + f"{split}_queries_dict.pkl", "rb") as f:
+        queries_dict = pickle.load(f)
+    with open(dic_save + f"{split}_que_top_dict.pkl", "rb") as f:
+        que_top_dict = pickle.load(f)
+    if queries == "alpha":
+        with open(dic_save + "alpha_querys_docs_list.pkl", "rb") as f:
+            que_top_dict = {query_name: que_top_dict[query_name] for query_name in pickle.load(f)}
+    return queries_dict, que_top_dict
+
+
+def firstStageInputs(dic_save, queries="test"):
+    """The files firstStage reads, the inputs the manifest keys the pair and row files on."""
+    split = "test" if queries == "test" else "train"
+    inputs = [dic_save + f"{split}_queries_dict.pkl", dic_save + f"{split}_que_top_dict.pkl"]
+    return inputs + ([dic_save + "alpha_querys_docs_list.pkl"] if queries == "alpha" else [])
+
+
+def writePairs(path, dic_save, top_k=None, queries="test"):
+    """Every (query, document) pair of the first-stage lists, in list order, as single-choice rows."""
+    writeTopRows(path, *firstStage(dic_save, queries), top_k, group_size=1)
+
+
+def writePassagePairs(path, dic_save, top_k=None, queries="test", max_passages=None):
+    """Every passage of every document of the first-stage lists as a single-choice row, documents in list order."""
+    queries_dict, que_top_dict = firstStage(dic_save, queries)
+    passage_store = openDocStore(dic_save + "passage_store")
+    with ExampleWriter(path, choice_column="top1000") as writefile:
+        for query_name, d_v in que_top_dict.items():
+            for doc_name in list(d_v.keys())[:top_k]:
+                for passage_name in passageNames(passage_store, doc_name)[:max_passages]:
+                    writefile.write(query_name, queries_dict[query_name], [passage_name], 0)
+
+
+def aggregatePassages(rows, logits, aggregation="maxp"):
+    """Single-choice (query, document) rows and their logits from the logits of single-passage rows."""
+    keys = {}
+    doc_index = np.array(
+        [keys.setdefault((query_name, passageDoc(doc_list[0])), len(keys)) for query_name, doc_list in rows],
+        dtype=np.int64,
+    )
+    values = np.asarray(logits, dtype=np.float64)[:, 0]
+    if aggregation == "sump":
+        scores = np.bincount(doc_index, weights=values, minlength=len(keys))
+    else:
+        # firstp rows hold the first passage alone, its max is itself
+        scores = np.full(len(keys), -np.inf)
+        np.maximum.at(scores, doc_index, values)
+    return [(query_name, [doc_name]) for query_name, doc_name in keys], scores[:, None]
+
+
+def referenceLogits(reference_file, rows, width):
+    """(rows, width) logits of an earlier output_file, looked up by (query, document)."""
+    reference_rows, reference_logits = readLogits(reference_file)
+    lookup = {}
+    for (query_name, doc_list), logits in zip(reference_rows, reference_logits):
+        lookup.update(((query_name, doc_name), logit) for doc_name, logit in zip(doc_list, logits))
+    logits = np.zeros((len(rows), width), dtype=np.float32)
+    for i, (query_name, doc_list) in enumerate(rows):
+        for j, doc_name in enumerate(doc_list):
+            if (query_name, doc_name) not in lookup:
+                raise ValueError(f"{reference_file} has no logit for ({query_name}, {doc_name}), it must cover every pair.")
+            logits[i, j] = lookup[query_name, doc_name]
+    return logits
+
+
+def compareLogits(rows, logits, reference, answers):
+    """Largest logit difference, and BERT-only MAP of both runs over the rows of queries with answers."""
+    check = {"max_logit_difference": float(np.abs(logits - reference).max(initial=0.0))}
+    labelled = {row[0] for row in rows} & set(answers.keys())
+    if not labelled:
+        # test queries have no answers, only the logits can be compared
+        return dict(check, map=None, reference_map=None, map_difference=None)
+    maps = []
+    for scores in (logits, reference):
+        matrix = alignScores(rows, scores, None, labelled)
+        relevant, n_relevant = matrix.relevant(answers)
+        maps.append(float(sweepAlpha(matrix, 0.0, relevant, n_relevant)[0]))
+    return dict(check, map=maps[0], reference_map=maps[1], map_difference=abs(maps[0] - maps[1]))
+
+
+def shardFile(shard_dir, shard):
+    return os.path.join(shard_dir, "shard-{:05d}.npy".format(shard))
+
+
+def _scoreShard(shard):
+    args, model = _worker["args"], _worker["model"]
+    rows = _worker["rows"]
+    start, stop = shard * args.shard_size, min((shard + 1) * args.shard_size, len(rows))
+    data = rows[start:stop]
+    lengths = np.array([len(choiceList(choices)) for choices in data[rows.column_names[2]]])
+    logits = np.zeros((stop - start, int(lengths.max(initial=1))), dtype=np.float32)
+    todo = np.arange(stop - start)
+    if _worker["scorer"] is not None:
+        # rows with every pair in the store are not scored again
+        choice_rows = _worker["choice_rows"][start:stop]
+        logits = _worker["store"].lookup(_worker["scorer"], choice_rows, logits.shape[1])
+        todo = np.flatnonzero(missingRows(logits, choice_rows))
+    features = encodeChoices(
+        _worker["tokenizer"],
+        _worker["token_cache"],
+        [data["query_content"][i] for i in todo],
+        [data[rows.column_names[2]][i] for i in todo],
+        _worker["max_length"],
+        default=_worker["missing_doc_ids"],
+        repeat_query=args.repeat_query,
+    )
+    features = [{k: v[i] for k, v in features.items()} for i in range(len(todo))]
+    if args.max_tokens_per_batch:
+        token_lengths = [max(len(x) for x in feature["input_ids"]) for feature in features]
+        num_choices = [len(feature["input_ids"]) for feature in features]
+        batches = TokenBudgetBatchSampler(token_lengths, num_choices, args.max_tokens_per_batch).batches
+    else:
+        batches = [list(range(i, min(i + args.batch_size, len(features)))) for i in range(0, len(features), args.batch_size)]
+    for batch_indices in batches:
+        batch = _worker["collator"]([dict(features[i], label=0) for i in batch_indices])
+        batch.pop("labels")
+        if args.engine is not None:
+            output = model(batch)
+        else:
+            with torch.no_grad():
+                output = model(**{k: v.to(model.device) for k, v in batch.items()}).logits.float().cpu().numpy()
+        # a batch is as wide as its widest row
+        logits[todo[batch_indices], : output.shape[1]] = output
+    # choices a shorter row does not have, padded in its batch
+    logits[np.arange(logits.shape[1]) >= lengths[:, None]] = 0.0
+    # write beside the final name and rename, a killed run never leaves half a shard
+    tmp = shardFile(args.shard_dir, shard) + ".tmp"
+    with open(tmp, "wb") as writefile:
+        np.save(writefile, logits)
+    os.replace(tmp, shardFile(args.shard_dir, shard))
+    return shard, len(todo)
+
+
+def main():
+    parser = HfArgumentParser(PredictArguments)
+    if len(sys.argv) == 2 and sys.argv[1].endswith(".json"):
+        (args,) = parser.parse_json_file(json_file=os.path.abspath(sys.argv[1]))
+    else:
+        (args,) = parser.parse_args_into_dataclasses()
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(name)s -   %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+        level=logging.INFO,
+    )
+
+    if args.queries not in ("test", "alpha", "train") or (args.queries != "test" and args.scoring == "choice"):
+        raise ValueError(f"Unknown queries {args.queries}, use test, or alpha / train with pointwise or passage scoring.")
+    if args.reference_file is not None and args.queries == "test" and args.logit_tolerance is None:
+        parser.error("--reference_file on the test queries needs --logit_tolerance, they have no answers to compare MAP on")
+    suffix = "" if args.top_k is None else "-top{}".format(args.top_k)
+    # a rewritten pair or row file leaves the shards cut from the old one behind
+    rewritten = False
+    output_format = os.path.splitext(findExampleFile(dic_save, "test"))[1][1:]
+    if args.scoring == "pointwise":
+        args.shard_dir = args.shard_dir or dic_save + f"{args.queries}_pointwise_shards{suffix}/"
+        args.output_file = args.output_file or dic_save + f"{args.queries}_pointwise_scores{suffix}.npy"
+        if args.test_file is None:
+            # one single-choice row per pair, kept so that a restarted run finds the same rows, and rewritten
+            # when the first-stage lists change
+            args.test_file = exampleFile(dic_save, f"{args.queries}_pairs{suffix}", output_format)
+            if Manifest(dic_save + "manifest.json").build(
+                os.path.basename(args.test_file),
+                firstStageInputs(dic_save, args.queries),
+                {"top_k": args.top_k, "queries": args.queries},
+                [args.test_file],
+                lambda: writePairs(args.test_file, dic_save, args.top_k, args.queries),
+                args.overwrite,
+            ):
+                rewritten = True
+                logger.info(f"*** Wrote (query, document) pairs to {args.test_file} ***")
+    elif args.scoring == "passage":
+        if args.aggregation not in ("maxp", "firstp", "sump"):
+            raise ValueError(f"Unknown aggregation {args.aggregation}, use maxp, firstp or sump.")
+        max_passages = 1 if args.aggregation == "firstp" else args.max_passages
+        passages = "" if max_passages is None else f"-p{max_passages}"
+        args.shard_dir = args.shard_dir or dic_save + f"{args.queries}_passage_shards{suffix}{passages}/"
+        args.output_file = args.output_file or dic_save + f"{args.queries}_{args.aggregation}_scores{suffix}.npy"
+        if args.test_file is None:
+            args.test_file = exampleFile(dic_save, f"{args.queries}_passages{suffix}{passages}", output_format)
+            if Manifest(dic_save + "manifest.json").build(
+                os.path.basename(args.test_file),
+                firstStageInputs(dic_save, args.queries) + [dic_save + "passage_store/ids.npy"],
+                {"top_k": args.top_k, "queries": args.queries, "max_passages": max_passages},
+                [args.test_file],
+                lambda: writePassagePairs(args.test_file, dic_save, args.top_k, args.queries, max_passages),
+                args.overwrite,
+            ):
+                rewritten = True
+                logger.info(f"*** Wrote (query, passage) pairs to {args.test_file} ***")
+    elif args.scoring == "choice":
+        group_suffix = "" if args.group_size is None else f"-g{args.group_size}"
+        args.shard_dir = args.shard_dir or dic_save + f"test_shards{suffix}{group_suffix}/"
+        args.output_file = args.output_file or dic_save + f"trainer_test_result{suffix}.npy"
+        if args.test_file is None and (args.top_k is not None or args.group_size is not None):
+            # the head of each list and / or rows of another size, bert.py --cascade_top_k --group_size writes the
+            # same file; without --group_size the rows keep the size preprocessing used
+            manifest = Manifest(dic_save + "manifest.json")
+            group_size = args.group_size or manifest.param("test", "group_size", 4)
+            args.test_file = exampleFile(dic_save, f"test{suffix}{group_suffix}", output_format)
+            if manifest.build(
+                os.path.basename(args.test_file),
+                firstStageInputs(dic_save),
+                {"top_k": args.top_k, "group_size": group_size},
+                [args.test_file],
+                lambda: writeTopRows(args.test_file, *firstStage(dic_save), args.top_k, group_size),
+                args.overwrite,
+            ):
+                rewritten = True
+                logger.info(f"*** Wrote the first-stage top {args.top_k} in rows of {group_size} to {args.test_file} ***")
+        args.test_file = args.test_file or findExampleFile(dic_save, "test")
+    else:
+        raise ValueError(f"Unknown scoring mode {args.scoring}, use choice, pointwise or passage.")
+
+    if args.reference_file is not None and os.path.abspath(args.reference_file) == os.path.abspath(args.output_file):
+        parser.error(f"--reference_file is the output_file {args.output_file}, the run would be checked against itself")
+
+    n_rows = len(loadExamples({"test": args.test_file})["test"])
+    n_shards = (n_rows + args.shard_size - 1) // args.shard_size
+
+    # shards are only resumable when they were cut from the same rows the same way
+    meta = {
+        "model_name_or_path": os.path.abspath(args.model_name_or_path),
+        "test_file": os.path.abspath(args.test_file),
+        "test_file_mtime": os.path.getmtime(args.test_file),
+        "rows": n_rows,
+        "shard_size": args.shard_size,
+        "max_seq_length": args.max_seq_length,
+        "repeat_query": args.repeat_query,
+        "engine": os.path.abspath(args.engine) if args.engine is not None else None,
+    }
+    meta_file = os.path.join(args.shard_dir, "meta.json")
+    if (args.overwrite or rewritten) and os.path.exists(args.shard_dir):
+        for name in os.listdir(args.shard_dir):
+            os.remove(os.path.join(args.shard_dir, name))
+    os.makedirs(args.shard_dir, exist_ok=True)
+    if os.path.exists(meta_file):
+        with open(meta_file) as f:
+            if json.load(f) != meta:
+                raise ValueError(
+                    f"{args.shard_dir} holds shards of another run, use --overwrite to start over."
+                )
+    else:
+        with open(meta_file, "w") as f:
+            json.dump(meta, f, indent=2)
+
+    # tokenize the documents before any worker needs them
+    tokenizer = AutoTokenizer.from_pretrained(args.model_name_or_path)
+    max_length = args.max_seq_length if args.max_seq_length is not None else tokenizer.model_max_length
+    token_cache_path = tokenCachePath(dic_save, tokenizer, max_length, args.scoring == "passage")
+    if not os.path.exists(token_cache_path):
+        logger.info("*** Tokenizing documents into {} ***".format(token_cache_path))
+        source = "passage_store" if args.scoring == "passage" else "docs_store"
+        buildTokenCache(token_cache_path, openDocStore(dic_save + source), tokenizer, max_length)
+
+    scorer = None
+    if args.score_store:
+        store = ScoreStore(args.score_store)
+        scorer = store.scorer(
+            args.engine or args.model_name_or_path, max_length=max_length, repeat_query=args.repeat_query, precision="fp32"
+        )
+
+    pending = [shard for shard in range(n_shards) if not os.path.exists(shardFile(args.shard_dir, shard))]
+    logger.info(f"*** {n_rows} rows in {n_shards} shards, {len(pending)} left to score ***")
+    if args.num_workers > 1:
+        # spawned, not forked: every worker gets its own torch thread pool
+        with get_context("spawn").Pool(args.num_workers, initializer=_initWorker, initargs=(args, scorer)) as pool:
+            for shard, scored in pool.imap_unordered(_scoreShard, pending):
+                logger.info(f"  shard {shard} done, {scored} rows scored")
+    elif pending:
+        _initWorker(args, scorer)
+        for shard in pending:
+            shard, scored = _scoreShard(shard)
+            logger.info(f"  shard {shard} done, {scored} rows scored")
+
+    logger.info("*** Merge shards ***")
+    shard_predictions = predictions = np.concatenate([np.load(shardFile(args.shard_dir, shard)) for shard in range(n_shards)])
+    shard_rows = readChoiceRows(args.test_file)
+    rows = shard_rows
+    if args.scoring == "passage":
+        logger.info(f"*** {len(rows)} passages to documents by {args.aggregation} ***")
+        rows, predictions = aggregatePassages(shard_rows, shard_predictions, args.aggregation)
+
+    # checked before anything is written, logits that fail never reach the output file nor the score store
+    if args.reference_file is not None:
+        logger.info(f"*** Check against {args.reference_file} ***")
+        reference = referenceLogits(args.reference_file, rows, predictions.shape[1])
+        answers = {}
+        if os.path.exists(dic_save + "train_que_pos_dict.pkl"):
+            with open(dic_save + "train_que_pos_dict.pkl", "rb") as f:
+                answers = pickle.load(f)
+        check = compareLogits(rows, predictions, reference, answers)
+        logger.info(f"  {check}")
+        if check["map_difference"] is not None and check["map_difference"] > args.map_tolerance:
+            raise ValueError(
+                f"MAP {check['map']:.4f} differs from the reference {check['reference_map']:.4f} "
+                f"by more than {args.map_tolerance}."
+            )
+        if args.logit_tolerance is not None and check["max_logit_difference"] > args.logit_tolerance:
+            raise ValueError(
+                f"Logits differ from the reference by up to {check['max_logit_difference']:.4f}, "
+                f"more than {args.logit_tolerance}."
+            )
+
+    if scorer is not None:
+        store.put(scorer, shard_rows, shard_predictions)
+        store.close()
+    writeLogits(args.output_file, rows, predictions)
+    logger.info("*** Done! ***")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,19 +2,27 @@
 # coding: utf-8
 
 ## import modules
-import glob , os , re , random , sys , math
+import glob , os , re , random , sys , math , zlib , shutil , argparse
 import pickle , csv
 import numpy as np
-import pandas as pd
 import collections
+import itertools
+from multiprocessing import Pool
 from tqdm import tqdm
-from datasets import load_dataset
+
+from artifacts import FORMATS, ExampleWriter, exampleFile, readLogits
+from docstore import DocStoreWriter, passageName, splitPassages
+from manifest import Manifest, atomicOutput
+from numerics import softmax
+from sampling import boundedImap, sampleQueries
 
 
 def pickleStore( savethings , filename ):
-    dbfile = open( filename , 'wb' )
-    pickle.dump( savethings , dbfile )
-    dbfile.close()
+    # written beside filename and renamed, an interrupted run never leaves half a pickle
+    with atomicOutput( filename ) as tmp:
+        dbfile = open( tmp , 'wb' )
+        pickle.dump( savethings , dbfile )
+        dbfile.close()
     return
 
 
@@ -24,33 +32,92 @@ def pickleOpen( filename ):
     return p
 
 
-def shuffleCutList( big_lists ):
+def shuffleCutList( big_lists , group_size=4 ):
+    # the last group is smaller when the list does not divide evenly, the collator pads it
     random.shuffle( big_lists )
-    new = [ big_lists[i:i+4] for i in range( 0 , len( big_lists ) , 4 ) ]
+    new = [ big_lists[i:i+group_size] for i in range( 0 , len( big_lists ) , group_size ) ]
     return new
 
 
+## text cleaning, patterns compiled once
+# the tags and the "article type:..." header of the raw documents, removed in one pass of one alternation;
+# the header alone is matched case-insensitively, and the lookahead fails fast at every other character
+CLEAN_PATTERN = re.compile( r"(?=[<aA])(?:(?i:(?:article)+\s(?:type)+:\w+)|<F P=10[56][^>]*>|</F>)" )
+# \W covers every whitespace, so once its runs are one space nothing is left to collapse
+NON_WORD_PATTERN = re.compile( r"\W+" )
+
+
 def cleanRaw( raw_html ):
-    cleana = re.compile( r"(article)+\s(type)+\:(\w+)" , re.IGNORECASE )
-    cleanb = re.compile( r"<F P=105[^>]*>" )
-    cleanc = re.compile( r"<F P=106[^>]*>" )
-    cleand = re.compile( r"</F>" )
-    cleantext = re.sub(cleana, '', raw_html)
-    cleantext = re.sub(cleanb, '', cleantext)
-    cleantext = re.sub(cleanc, '', cleantext)
-    cleantext = re.sub(cleand, '', cleantext)
-    return cleantext
+    return CLEAN_PATTERN.sub( '' , raw_html )
+
+
+def normalizeQuery( text ):
+    return NON_WORD_PATTERN.sub( ' ' , text ).strip()
 
 
-def softmax( vector ):
-	e = np.exp( vector )
-	return e / e.sum()
+def cleanRows( rows ):
+    # a chunk of ( doc_name , text ) rows, for the pool
+    return [ ( doc_name , normalizeQuery( cleanRaw( text ) ) ) for doc_name , text in rows ]
+
+
+def readDocuments( filename , clean=False , num_workers=1 , chunk_size=1000 ):
+    # ( doc_name , text ) of every document in file order, cleaned by num_workers processes when clean
+    with open( filename , newline='' ) as csvfile:
+        spamreader = csv.reader( csvfile , delimiter=',' )
+        next( spamreader )
+        rows = ( ( row[0] , row[1] ) for row in spamreader )
+        if not clean:
+            yield from rows
+            return
+        chunks = iter( lambda: list( itertools.islice( rows , chunk_size ) ) , [] )
+        if num_workers is not None and num_workers > 1:
+            # two chunks per worker read ahead, the file is read as the workers take them
+            with Pool( num_workers ) as pool:
+                for chunk in boundedImap( pool , cleanRows , chunks , 1 , 2 * num_workers ):
+                    yield from chunk
+        else:
+            for chunk in map( cleanRows , chunks ):
+                yield from chunk
+
+
+def readQueries( filename , with_positives=True ):
+    # one query row at a time: ( query_name , query_content , positives , top docs , top softmax scores )
+    with open( filename , newline='' ) as csvfile:
+        spamreader = csv.reader( csvfile , delimiter=',' )
+        next( spamreader )
+        for row in spamreader:
+            if with_positives:
+                yield row[0] , normalizeQuery( row[1] ) , row[2] , row[3].split() , softmax( np.array( row[4].split() , dtype=np.float64 ) )
+            else:
+                yield row[0] , normalizeQuery( row[1] ) , None , row[2].split() , softmax( np.array( row[3].split() , dtype=np.float64 ) )
+
+
+def hashSplit( key , test_size ):
+    # True for the validation share; crc32 gives the same split on every run and machine
+    return zlib.crc32( key.encode( "utf-8" ) ) / 2 ** 32 < test_size
 
 
 if __name__  == "__main__":
 
+    parser = argparse.ArgumentParser()
+    parser.add_argument( "--seed" , type=int , default=42 , help="seed of the negative sampling and the alpha query draw" )
+    parser.add_argument( "--num_workers" , type=int , default=1 , help="processes sampling training rows and cleaning documents" )
+    parser.add_argument( "--output_format" , default="csv" , choices=list( FORMATS.keys() ) , help="file format of the example files" )
+    parser.add_argument( "--group_size" , type=int , default=4 , help="choices per row: a positive and group_size - 1 negatives for training, group_size documents for test" )
+    parser.add_argument( "--negatives" , default="half" , choices=[ "half" , "band" ] , help="negatives of the training rows: the lower half of the first-stage list, or the ranks of --band" )
+    parser.add_argument( "--band" , type=int , nargs=2 , default=[ 10 , 100 ] , help="first and last + 1 rank of the band negatives come from" )
+    parser.add_argument( "--without_replacement" , action="store_true" , help="no negative twice in a row, nor again in a query before its whole pool was used" )
+    parser.add_argument( "--mine_scores" , default=None , help="re-mine: rank the candidates by these scores of the current checkpoint ( predict.py --scoring pointwise --queries train ) instead of first-stage order" )
+    parser.add_argument( "--clean" , action="store_true" , help="strip the tags of the raw documents and every non-word character before storing them" )
+    parser.add_argument( "--passage_words" , type=int , default=None , help="also split every document into passages of this many words, for predict.py --scoring passage" )
+    parser.add_argument( "--passage_stride" , type=int , default=None , help="words between passage starts, half of --passage_words by default" )
+    parser.add_argument( "--max_passages" , type=int , default=16 , help="passages kept per document, from its start" )
+    parser.add_argument( "--force" , action="store_true" , help="rebuild every artifact, fresh or not" )
+    args = parser.parse_args()
+
     ## settings
     csv.field_size_limit( sys.maxsize )
+    random.seed( args.seed )
 
     ## global variables
     dic_sources = 'data/'
@@ -60,121 +127,135 @@ if __name__  == "__main__":
         os.makedirs( dic_save )
 
     ## preprocessing
+    # every stage reads its csv row by row and writes its output as it goes,
+    # only the per-query dicts that later scripts load are kept in memory
+    # a stage runs only when save/manifest.json says its inputs, parameters or outputs changed,
+    # every output is written to a temporary name first and renamed when complete
+    manifest = Manifest( dic_save + "manifest.json" )
+
+    def stale( stage , inputs , params , outputs ):
+        if args.force or manifest.stale( stage , inputs , params , outputs ):
+            print( "{}: rebuilding".format( stage ) )
+            return True
+        print( "{}: up to date".format( stage ) )
+        return False
+
+    def exampleOutputs( names ):
+        return [ exampleFile( dic_save , name , args.output_format ) for name in names ]
+
+    def dropOtherFormats( names ):
+        # example files left by a run in another format would shadow the new ones in findExampleFile
+        for name in names:
+            for output_format in FORMATS:
+                if output_format != args.output_format and os.path.exists( exampleFile( dic_save , name , output_format ) ):
+                    os.remove( exampleFile( dic_save , name , output_format ) )
+
     # save document file
-    docs_dict = {}
-    with open( dic_sources + 'documents.csv' , newline='' ) as csvfile:
-        spamreader = csv.reader( csvfile , delimiter=',' )
-        next( spamreader )
-        for c , row in enumerate( spamreader ):
-            # get content without first line features name
-            # docs_dict[ row[0] ] =  " ".join( re.sub( r'\W+' , ' ' , cleanRaw( row[1] ) ).replace( "\n" , " " ).split() )
-            docs_dict[ row[0] ] =  row[1]
-    pickleStore( docs_dict , dic_save + "docs_dict.pkl" )
-
-    # make train data
-    queries_dict = {}
-    que_pos_dict = {}
-    que_top_dict = {}
-    with open( dic_sources + 'train_queries.csv' , newline='' ) as csvfile:
-        spamreader = csv.reader( csvfile , delimiter=',' )
-        next( spamreader )
-        for c , row in enumerate( spamreader ):
-            queries_dict[ row[0] ] = " ".join( re.sub( r'\W+' , ' ' , row[1] ).split() )
-            que_pos_dict[ row[0] ] = row[2]
-            softmax_score = softmax( np.array( row[4].split() , dtype=np.float64 ) )
-            que_top_dict[ row[0] ] = dict( zip( row[3].split() , softmax_score.tolist() ) )
-    pickleStore( queries_dict , dic_save + "train_queries_dict.pkl" )
-    pickleStore( que_pos_dict , dic_save + "train_que_pos_dict.pkl" )
-    pickleStore( que_top_dict , dic_save + "train_que_top_dict.pkl" )
-    with open( dic_save + "all.csv" , "a" ) as writefile:
-        writefile.write( "query_name,query_content,answer,label\n" )
-        for query_name , query_content in queries_dict.items():
-            positive_list = que_pos_dict[ query_name ].split()
-            for i in range( len( positive_list ) ):
-                positive = positive_list[ i ]
-                # negative = " ".join( random.choices( [ x for x in que_top_dict[ query_name ].keys() if x not in que_pos_dict[ query_name ].split() ] , k=3 ) )
-                if len( que_top_dict[ query_name ].keys() ) // len( que_pos_dict[ query_name ].split() ) >= 10:
-                    temp = list( que_top_dict[ query_name ].keys() )[ len( que_top_dict[ query_name ].keys() ) // 2 :]
-                else:
-                    temp = que_top_dict[ query_name ].keys()
-                negative = random.choices( [ x for x in temp if x not in que_pos_dict[ query_name ].split() ] , k=3 )
-                # print( len( que_pos_dict[ query_name ].split() ) , len( [ x for x in que_top_dict[ query_name ].keys() if x not in que_pos_dict[ query_name ].split() ] ) )
-                random_l = [ positive ] + negative
-                random.shuffle( random_l )
-                index_el = random_l.index( positive )
-                random_l = " ".join( random_l )
-                append = ",".join( [ query_name , query_content , random_l , str( index_el ) ] )
-                writefile.write( append + "\n" )
-    # train
-    datasets = load_dataset( "csv" , data_files=dic_save + "all.csv" )
-    datasets = datasets['train'].train_test_split( test_size=0.04 , shuffle=True )
-    with open( dic_save + "train.csv" , "a" ) as writefile:
-        writefile.write( "query_name,query_content,answer,label\n" )
-        for row in datasets['train']:
-            append = ",".join( [ str(x) for x in row.values() ] )
-            writefile.write( append + "\n" )
-    # validation  
-    with open( dic_save + "validation.csv" , "a" ) as writefile:
-        writefile.write( "query_name,query_content,answer,label\n" )
-        for row in datasets['test']:
-            append = ",".join( [ str(x) for x in row.values() ] )
-            writefile.write( append + "\n" )
-
-
-    ## alpha training
-    d_list = [ str(x) for x in random.choices( list( pd.read_csv( dic_sources + 'train_queries.csv' )['query_id'] ) , k=60 ) ]
-    t_list = []
-    with open( dic_save + "train_for_alpha_train.csv" , "a" ) as writefile:
-        writefile.write( "query_name,query_content,answer,label\n" )
-        for query_name , query_content in queries_dict.items():
-            if query_name in d_list:
-                positive_list = que_pos_dict[ query_name ].split()
-                for i in range( len( positive_list ) ):
-                    positive = positive_list[ i ]
-                    if len( que_top_dict[ query_name ].keys() ) // len( que_pos_dict[ query_name ].split() ) >= 10:
-                        temp = list( que_top_dict[ query_name ].keys() )[ len( que_top_dict[ query_name ].keys() ) // 2 :]
-                    else:
-                        temp = que_top_dict[ query_name ].keys()
-                    negative = random.choices( [ x for x in temp if x not in que_pos_dict[ query_name ].split() ] , k=3 )
-                    random_l = [ positive ] + negative
-                    random.shuffle( random_l )
-                    index_el = random_l.index( positive )
-                    random_l = " ".join( random_l )
-                    append = ",".join( [ query_name , query_content , random_l , str( index_el ) ] )
-                    t_list.append( append )
-        random.shuffle( t_list )
-        for row in t_list:
-            writefile.write( row + "\n" )
-    pickleStore( d_list , dic_save + "alpha_querys_docs_list.pkl" )
-
-    # datasets_for_alpha_train = load_dataset( "csv" , data_files=dic_save + "all_alpha.csv" ).shuffle()
-    # with open( dic_save + "train_for_alpha_train.csv" , "a" ) as writefile:
-    #     writefile.write( "query_name,query_content,answer,label\n" )
-    #     for row in datasets_for_alpha_train['train']:
-    #         append = ",".join( [ str(x) for x in row.values() ] )
-    #         writefile.write( append + "\n" )
-
-
-    ## make test data
-    queries_dict = {}
-    que_top_dict = {}
-    que_all_list = []
-    with open( dic_sources + 'test_queries.csv' , newline='' ) as csvfile:
-        spamreader = csv.reader( csvfile , delimiter=',' )
-        next( spamreader )
-        for c , row in enumerate( spamreader ):
-            queries_dict[ row[0] ] = " ".join( re.sub( r'\W+' , ' ' , row[1] ).split() )
-            softmax_score = softmax( np.array( row[3].split() , dtype=np.float64 ) )
-            que_top_dict[ row[0] ] = dict( zip( row[2].split() , softmax_score.tolist() ) )
-    pickleStore( queries_dict , dic_save + "test_queries_dict.pkl" )
-    pickleStore( que_top_dict , dic_save + "test_que_top_dict.pkl" )
-    for query_name , query_content in queries_dict.items():
-        docs_list = list( que_top_dict[ query_name ].keys() )
-        doc4_list = shuffleCutList( docs_list )
-        for x in doc4_list:
-            que_all_list.append( ",".join( [ query_name , query_content , " ".join( x ) , str(0) ] ) )
-    random.shuffle( que_all_list )
-    with open( dic_save + "test.csv" , "a" ) as writefile:
-        writefile.write( "query_name,query_content,top1000,label\n" )
-        for row in que_all_list:
-            writefile.write( row + "\n" )
+    inputs  = [ dic_sources + 'documents.csv' ]
+    params  = { "clean" : args.clean }
+    outputs = [ dic_save + "docs_store" ]
+    if stale( "documents" , inputs , params , outputs ):
+        with atomicOutput( dic_save + "docs_store" ) as tmp , DocStoreWriter( tmp ) as docs_store:
+            for doc_name , text in readDocuments( dic_sources + 'documents.csv' , args.clean , args.num_workers ):
+                docs_store.add( doc_name , text )
+        # documents tokenized by bert.py / predict.py are out of date with the store
+        shutil.rmtree( dic_save + "token_cache" , ignore_errors=True )
+        manifest.record( "documents" , inputs , params , outputs )
+
+    # overlapping passages of every document, so that BERT sees more of a long one than its first max_seq_length tokens
+    inputs  = [ dic_sources + 'documents.csv' ]
+    params  = { "words" : args.passage_words , "stride" : args.passage_stride or ( args.passage_words or 0 ) // 2 , "max_passages" : args.max_passages , "clean" : args.clean }
+    outputs = [ dic_save + "passage_store" ]
+    if args.passage_words and stale( "passages" , inputs , params , outputs ):
+        with atomicOutput( dic_save + "passage_store" ) as tmp , DocStoreWriter( tmp ) as passage_store:
+            for doc_name , text in readDocuments( dic_sources + 'documents.csv' , args.clean , args.num_workers ):
+                for i , passage in enumerate( splitPassages( text , params[ "words" ] , params[ "stride" ] , params[ "max_passages" ] ) ):
+                    passage_store.add( passageName( doc_name , i ) , passage )
+        for path in glob.glob( dic_save + "token_cache/passages-*" ):
+            shutil.rmtree( path )
+        manifest.record( "passages" , inputs , params , outputs )
+
+    # alpha training queries, drawn from the query ids alone
+    inputs  = [ dic_sources + 'train_queries.csv' ]
+    params  = { "seed" : args.seed , "alpha_queries" : 60 }
+    outputs = [ dic_save + "alpha_querys_docs_list.pkl" ]
+    if stale( "alpha_split" , inputs , params , outputs ):
+        with open( dic_sources + 'train_queries.csv' , newline='' ) as csvfile:
+            spamreader = csv.reader( csvfile , delimiter=',' )
+            next( spamreader )
+            query_ids = [ row[0] for row in spamreader ]
+        pickleStore( random.Random( args.seed ).sample( query_ids , min( params[ "alpha_queries" ] , len( query_ids ) ) ) , dic_save + "alpha_querys_docs_list.pkl" )
+        manifest.record( "alpha_split" , inputs , params , outputs )
+
+    # make train data: sampled rows go straight to all and to their train / validation split
+    inputs  = [ dic_sources + 'train_queries.csv' , dic_save + "alpha_querys_docs_list.pkl" ] + ( [ args.mine_scores ] if args.mine_scores else [] )
+    mining  = { "strategy" : args.negatives , "band" : tuple( args.band ) , "replace" : not args.without_replacement }
+    params  = { "seed" : args.seed , "output_format" : args.output_format , "validation_size" : 0.04 , "group_size" : args.group_size , "mining" : mining }
+    outputs = exampleOutputs( [ "all" , "train" , "validation" , "train_for_alpha_train" ] ) + [ dic_save + "train_queries_dict.pkl" , dic_save + "train_que_pos_dict.pkl" , dic_save + "train_que_top_dict.pkl" ]
+    if stale( "train" , inputs , params , outputs ):
+        dropOtherFormats( [ "all" , "train" , "validation" , "train_for_alpha_train" ] )
+        alpha_set = set( pickleOpen( dic_save + "alpha_querys_docs_list.pkl" ) )
+        queries_dict = {}
+        que_pos_dict = {}
+        que_top_dict = {}
+        t_list = []
+        # { query_name : { doc_name : score } } of the checkpoint the negatives are re-mined with
+        mine_scores = {}
+        if args.mine_scores:
+            for ( query_name , doc_list ) , logits in zip( *readLogits( args.mine_scores ) ):
+                mine_scores.setdefault( query_name , {} ).update( zip( doc_list , logits.tolist() ) )
+
+        def train_tasks():
+            # the query dicts fill up as the sampling workers take queries
+            for query_name , query_content , positives , top_docs , softmax_score in readQueries( dic_sources + 'train_queries.csv' ):
+                queries_dict[ query_name ] = query_content
+                que_pos_dict[ query_name ] = positives
+                que_top_dict[ query_name ] = dict( zip( top_docs , softmax_score.tolist() ) )
+                scores = None
+                if args.mine_scores:
+                    scores = np.array( [ mine_scores.get( query_name , {} ).get( doc_name , -np.inf ) for doc_name in top_docs ] )
+                yield query_name , query_content , positives , top_docs , query_name in alpha_set , args.seed , args.group_size , mining , scores
+
+        with atomicOutput( exampleFile( dic_save , "all" , args.output_format ) ) as all_tmp , \
+             atomicOutput( exampleFile( dic_save , "train" , args.output_format ) ) as train_tmp , \
+             atomicOutput( exampleFile( dic_save , "validation" , args.output_format ) ) as valid_tmp :
+            with ExampleWriter( all_tmp ) as allfile , ExampleWriter( train_tmp ) as trainfile , ExampleWriter( valid_tmp ) as validfile:
+                for rows , alpha_rows in sampleQueries( train_tasks() , args.num_workers ):
+                    for row in rows:
+                        allfile.write( *row )
+                        if hashSplit( ",".join( [ row[0] , row[1] , " ".join( row[2] ) , str( row[3] ) ] ) , params[ "validation_size" ] ):
+                            validfile.write( *row )
+                        else:
+                            trainfile.write( *row )
+                    ## alpha training, an independent sample for the chosen queries
+                    t_list.extend( alpha_rows )
+        pickleStore( queries_dict , dic_save + "train_queries_dict.pkl" )
+        pickleStore( que_pos_dict , dic_save + "train_que_pos_dict.pkl" )
+        pickleStore( que_top_dict , dic_save + "train_que_top_dict.pkl" )
+
+        with atomicOutput( exampleFile( dic_save , "train_for_alpha_train" , args.output_format ) ) as tmp , ExampleWriter( tmp ) as writefile:
+            random.Random( args.seed ).shuffle( t_list )
+            for row in t_list:
+                writefile.write( *row )
+        manifest.record( "train" , inputs , params , outputs )
+
+
+    ## make test data: every query's top list in random groups of group_size, written as the query is read
+    inputs  = [ dic_sources + 'test_queries.csv' ]
+    params  = { "seed" : args.seed , "output_format" : args.output_format , "group_size" : args.group_size }
+    outputs = exampleOutputs( [ "test" ] ) + [ dic_save + "test_queries_dict.pkl" , dic_save + "test_que_top_dict.pkl" ]
+    if stale( "test" , inputs , params , outputs ):
+        # shuffleCutList draws from the global generator, seeded here so the groups do not depend on the stages run before
+        random.seed( args.seed )
+        dropOtherFormats( [ "test" ] )
+        queries_dict = {}
+        que_top_dict = {}
+        with atomicOutput( exampleFile( dic_save , "test" , args.output_format ) ) as tmp , ExampleWriter( tmp , choice_column="top1000" ) as writefile:
+            for query_name , query_content , _ , top_docs , softmax_score in readQueries( dic_sources + 'test_queries.csv' , with_positives=False ):
+                queries_dict[ query_name ] = query_content
+                que_top_dict[ query_name ] = dict( zip( top_docs , softmax_score.tolist() ) )
+                for x in shuffleCutList( list( top_docs ) , args.group_size ):
+                    writefile.write( query_name , query_content , x , 0 )
+        pickleStore( queries_dict , dic_save + "test_queries_dict.pkl" )
+        pickleStore( que_top_dict , dic_save + "test_que_top_dict.pkl" )
+        manifest.record( "test" , inputs , params , outputs )
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import zlib , itertools
+import numpy as np
+from collections import deque
+from multiprocessing import Pool
+
+
+## negative sampling for the group_size-choice training rows ( 4 by default: a positive and 3 negatives )
+# every query gets its own generator seeded by ( seed , crc32( query_name ) , stream ),
+# so the rows do not depend on which worker, or how many workers, sampled the query
+# the negatives of a query are indexed once, as int positions into its first-stage list ranked hardest first;
+# the pool of a strategy is a slice of that index, and re-mining only reorders it by a checkpoint's scores
+
+
+def negativeIndex( positive_list , top_docs , scores=None ):
+    # ( rank , position ) of every negative: positions into top_docs ordered hardest first, by their first-stage
+    # order or, when re-mining, by the current checkpoint's scores ( unscored documents last, in list order ),
+    # and the rank of each in that order over the whole list
+    top_docs = np.asarray( top_docs )
+    order = np.arange( len( top_docs ) ) if scores is None else np.argsort( -np.asarray( scores , dtype=np.float64 ) , kind="stable" )
+    negative = ~np.isin( top_docs[ order ] , positive_list )
+    return np.flatnonzero( negative ) , order[ negative ]
+
+
+def negativePool( positive_list , top_docs , strategy="half" , band=( 10 , 100 ) , scores=None , min_size=3 ):
+    # half : the lower half of the list when it has 10 docs or more per positive, else all of it
+    # band : the negatives ranked band[0] to band[1] - 1, hard but past the likely unlabelled positives;
+    #        all negatives when the band holds fewer than min_size, the negatives of one row
+    top_docs = np.asarray( top_docs )
+    ranks , positions = negativeIndex( positive_list , top_docs , scores )
+    if strategy == "band":
+        in_band = ( ranks >= band[0] ) & ( ranks < band[1] )
+        if in_band.sum() >= min_size:
+            positions = positions[ in_band ]
+    elif len( top_docs ) // len( positive_list ) >= 10:
+        positions = positions[ ranks >= len( top_docs ) // 2 ]
+    return top_docs[ positions ]
+
+
+def queryRng( seed , query_name , stream=0 ):
+    return np.random.default_rng( [ seed , zlib.crc32( query_name.encode( "utf-8" ) ) , stream ] )
+
+
+def sampleChoices( query_name , query_content , positive_list , pool , rng , replace=True , group_size=4 ):
+    # one ( query_name , query_content , choices , label ) row per positive:
+    # the positive and group_size - 1 negatives, shuffled, label = position of the positive
+    # without replacement the negatives come from successive permutations of the pool, a row never straddling two,
+    # so no row repeats a negative and the query goes through its whole pool before any negative comes back
+    k = group_size - 1
+    rows , cycle = [] , []
+    for positive in positive_list:
+        if replace or len( pool ) < k:
+            negatives = rng.choice( pool , k ).tolist()
+        else:
+            if len( cycle ) < k:
+                cycle = pool[ rng.permutation( len( pool ) ) ].tolist()
+            negatives , cycle = cycle[ : k ] , cycle[ k : ]
+        random_l = [ positive ] + negatives
+        order = rng.permutation( group_size ).tolist()
+        index_el = order.index( 0 )
+        random_l = [ random_l[ i ] for i in order ]
+        rows.append( ( query_name , query_content , random_l , index_el ) )
+    return rows
+
+
+def sampleQuery( task ):
+    # task : ( query_name , query_content , positives , top_docs , alpha , seed , group_size , mining , scores )
+    # mining : { "strategy" : half | band , "band" : ( lo , hi ) , "replace" : bool } of the training rows,
+    # scores : the current checkpoint's score of every doc of top_docs to re-mine with, or None
+    # gives the training rows, and a second independent sample when the query is an alpha query; that one
+    # keeps the half pool with replacement whatever the mining, it tunes fusion on rows like the old ones
+    query_name , query_content , positives , top_docs , alpha , seed , group_size , mining , scores = task
+    positive_list = positives.split()
+    # a query without positives has no rows, nor a pool to draw them from
+    if not positive_list:
+        return [] , []
+    pool = negativePool( positive_list , top_docs )
+    train_pool = negativePool( positive_list , top_docs , mining[ "strategy" ] , mining[ "band" ] , scores , group_size - 1 )
+    rows = sampleChoices( query_name , query_content , positive_list , train_pool , queryRng( seed , query_name , 0 ) , mining[ "replace" ] , group_size )
+    alpha_rows = sampleChoices( query_name , query_content , positive_list , pool , queryRng( seed , query_name , 1 ) , group_size=group_size ) if alpha else []
+    return rows , alpha_rows
+
+
+def _mapChunk( func , chunk ):
+    return [ func( item ) for item in chunk ]
+
+
+def boundedImap( pool , func , items , chunksize=1 , window=2 ):
+    # pool.imap( func , items , chunksize ), results in item order, with at most window chunks read ahead;
+    # imap's feeder thread would drain items into the task queue as fast as it can, a whole corpus at once
+    items = iter( items )
+    pending = deque()
+    while True:
+        while len( pending ) < window:
+            chunk = list( itertools.islice( items , chunksize ) )
+            if not chunk:
+                break
+            pending.append( pool.apply_async( _mapChunk , ( func , chunk ) ) )
+        if not pending:
+            return
+        yield from pending.popleft().get()
+
+
+def sampleQueries( tasks , num_workers=1 , chunksize=16 ):
+    # results come back in task order, so the output files are the same for any num_workers;
+    # two chunks per worker are in flight, the tasks are read as the workers take them
+    if num_workers is not None and num_workers > 1:
+        with Pool( num_workers ) as pool:
+            yield from boundedImap( pool , sampleQuery , tasks , chunksize , 2 * num_workers )
+    else:
+        yield from map( sampleQuery , tasks )
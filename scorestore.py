@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import os , glob , json , sqlite3 , hashlib
+import numpy as np
+
+from manifest import sha256File
+
+
+## persistent store of model logits keyed by ( scorer , query , document )
+# a scorer is a checkpoint ( the sha256 of its weight files ) with the settings that change its logits
+# ( max_length , repeat_query , precision ); a choice's logit does not depend on the other choices of its row,
+# so a pair scored once is looked up by key from then on, whatever row or file order it comes back in
+# one SQLite file in WAL mode: one process writes, any number read
+# rows are ( query_name , [ doc_name , ... ] ) as readChoiceRows gives them, logits ( rows , choices )
+
+WEIGHT_FILES = ( "config.json" , "*.safetensors" , "*.bin" , "*.pt" , "*.onnx" )
+
+
+def missingRows( logits , rows ):
+    # rows with a choice the store has no logit for
+    return np.array( [ np.isnan( logits[ i , : len( doc_list ) ] ).any() for i , ( _ , doc_list ) in enumerate( rows ) ] , dtype=bool )
+
+
+class ScoreStore:
+
+    def __init__( self , path ):
+        self.path = path
+        self.db = sqlite3.connect( path , timeout=600 )
+        self.db.execute( "PRAGMA journal_mode=WAL" )
+        self.db.executescript( """
+            CREATE TABLE IF NOT EXISTS files ( path TEXT PRIMARY KEY , size INTEGER , mtime_ns INTEGER , sha256 TEXT );
+            CREATE TABLE IF NOT EXISTS scorers ( id INTEGER PRIMARY KEY , key TEXT UNIQUE , checkpoint TEXT , settings TEXT );
+            CREATE TABLE IF NOT EXISTS scores ( scorer INTEGER , query TEXT , doc TEXT , logit REAL , PRIMARY KEY ( scorer , query , doc ) ) WITHOUT ROWID;
+        """ )
+
+    def fileHash( self , path ):
+        # cached by ( size , mtime ), a checkpoint is hashed once
+        path = os.path.abspath( path )
+        stat = os.stat( path )
+        cached = self.db.execute( "SELECT size , mtime_ns , sha256 FROM files WHERE path = ?" , ( path , ) ).fetchone()
+        if cached is not None and cached[:2] == ( stat.st_size , stat.st_mtime_ns ):
+            return cached[2]
+        digest = sha256File( path )
+        with self.db:
+            self.db.execute( "INSERT OR REPLACE INTO files VALUES ( ? , ? , ? , ? )" , ( path , stat.st_size , stat.st_mtime_ns , digest ) )
+        return digest
+
+    def checkpointHash( self , checkpoint ):
+        # weight files of a model or engine directory; a hub name has nothing to hash but its name
+        if not os.path.isdir( checkpoint ):
+            return hashlib.sha256( checkpoint.encode( "utf-8" ) ).hexdigest()
+        files = sorted( set( path for pattern in WEIGHT_FILES for path in glob.glob( os.path.join( checkpoint , pattern ) ) ) )
+        description = [ ( os.path.basename( path ) , self.fileHash( path ) ) for path in files ]
+        return hashlib.sha256( json.dumps( description ).encode( "utf-8" ) ).hexdigest()
+
+    def scorer( self , checkpoint , create=True , **settings ):
+        # id of the scorer, registered on first use; a reader passes create=False and gets None for a
+        # checkpoint never scored with these settings
+        checkpoint_hash = self.checkpointHash( checkpoint )
+        settings = json.dumps( settings , sort_keys=True )
+        key = hashlib.sha256( ( checkpoint_hash + settings ).encode( "utf-8" ) ).hexdigest()
+        if create:
+            with self.db:
+                self.db.execute( "INSERT OR IGNORE INTO scorers ( key , checkpoint , settings ) VALUES ( ? , ? , ? )" , ( key , checkpoint_hash , settings ) )
+        found = self.db.execute( "SELECT id FROM scorers WHERE key = ?" , ( key , ) ).fetchone()
+        return None if found is None else found[0]
+
+    def lookup( self , scorer , rows , width=None ):
+        # ( rows , width ) float32 logits, NaN where the store has none
+        width = width if width is not None else max( ( len( doc_list ) for _ , doc_list in rows ) , default=0 )
+        logits = np.full( ( len( rows ) , width ) , np.nan , dtype=np.float32 )
+        by_query = {}
+        for i , ( query_name , _ ) in enumerate( rows ):
+            by_query.setdefault( query_name , [] ).append( i )
+        for query_name , indices in by_query.items():
+            scores = dict( self.db.execute( "SELECT doc , logit FROM scores WHERE scorer = ? AND query = ?" , ( scorer , query_name ) ) )
+            for i in indices:
+                logits[ i , : len( rows[ i ][1] ) ] = [ scores.get( doc_name , np.nan ) for doc_name in rows[ i ][1] ]
+        return logits
+
+    def put( self , scorer , rows , logits ):
+        # a pair already in the store keeps its first logit
+        pairs = ( ( scorer , query_name , doc_name , float( logit ) ) for ( query_name , doc_list ) , row_logits in zip( rows , logits ) for doc_name , logit in zip( doc_list , row_logits ) )
+        with self.db:
+            self.db.executemany( "INSERT OR IGNORE INTO scores VALUES ( ? , ? , ? , ? )" , pairs )
+
+    def close( self ):
+        self.db.close()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import os , re , shutil
+import numpy as np
+
+from artifacts import choiceList
+from docstore import MappedByPath, findName
+
+
+## pre-tokenized document cache
+# one directory per ( tokenizer , max_length ), next to the document store
+# ids.npy     : document names, sorted, same order as the document store
+# tokens.bin  : int32 token ids of every document, no special tokens, one after another
+# offsets.npy : where each document starts inside tokens.bin, plus the final end
+# documents are cut to max_length tokens, a pair never has room for more of them
+
+
+def cacheName( tokenizer , max_length ):
+    name = re.sub( r'\W+' , '_' , tokenizer.name_or_path ).strip( '_' ) or "tokenizer"
+    return "{0}-{1}".format( name , max_length )
+
+
+def tokenCachePath( dic_save , tokenizer , max_length , passages=False ):
+    # passages : the cache of the passage store instead of the document store
+    return os.path.join( dic_save , "token_cache" , ( "passages-" if passages else "" ) + cacheName( tokenizer , max_length ) )
+
+
+def buildTokenCache( path , docs_store , tokenizer , max_length , batch_size=1000 ):
+    # write next to the final place and rename, an interrupted build never looks finished
+    tmp = path + ".tmp"
+    shutil.rmtree( tmp , ignore_errors=True )
+    os.makedirs( tmp )
+    ids = np.array( docs_store.ids )
+    offsets = np.zeros( len( ids ) + 1 , dtype=np.int64 )
+    with open( os.path.join( tmp , "tokens.bin" ) , "wb" ) as writefile:
+        for start in range( 0 , len( ids ) , batch_size ):
+            texts = [ docs_store[ doc_name ] for doc_name in ids[ start : start + batch_size ] ]
+            encoded = tokenizer( texts , add_special_tokens=False , truncation=True , max_length=max_length )
+            for i , token_ids in enumerate( encoded[ "input_ids" ] ):
+                np.asarray( token_ids , dtype=np.int32 ).tofile( writefile )
+                offsets[ start + i + 1 ] = offsets[ start + i ] + len( token_ids )
+    np.save( os.path.join( tmp , "ids.npy" ) , ids )
+    np.save( os.path.join( tmp , "offsets.npy" ) , offsets )
+    shutil.rmtree( path , ignore_errors=True )
+    os.replace( tmp , path )
+    return path
+
+
+class TokenCache( MappedByPath ):
+
+    def __init__( self , path ):
+        self.path    = path
+        self.ids     = np.load( os.path.join( path , "ids.npy" ) , mmap_mode="r" )
+        self.offsets = np.load( os.path.join( path , "offsets.npy" ) , mmap_mode="r" )
+        if os.path.getsize( os.path.join( path , "tokens.bin" ) ) > 0:
+            self.tokens = np.memmap( os.path.join( path , "tokens.bin" ) , dtype=np.int32 , mode="r" )
+        else:
+            self.tokens = np.zeros( 0 , dtype=np.int32 )
+
+    def __getitem__( self , doc_name ):
+        i = findName( self.ids , doc_name )
+        if i < 0:
+            raise KeyError( doc_name )
+        return self.tokens[ self.offsets[ i ] : self.offsets[ i + 1 ] ].tolist()
+
+    def get( self , doc_name , default=None ):
+        try:
+            return self[ doc_name ]
+        except KeyError:
+            return default
+
+    def __contains__( self , doc_name ):
+        return findName( self.ids , doc_name ) >= 0
+
+    def __len__( self ):
+        return len( self.ids )
+
+
+# caches already opened by this process, keyed by path
+_caches = {}
+
+
+def openTokenCache( path ):
+    if path not in _caches:
+        _caches[ path ] = TokenCache( path )
+    return _caches[ path ]
+
+
+# cut a pair down to budget tokens the way truncation=True ( longest_first ) does:
+# the longer sequence loses tokens from its end first, then both lose them in turn;
+# on an odd count the fast ( rust ) tokenizers cut the first one more, the python ones the second
+def truncatePair( first_ids , second_ids , budget , first_loses_odd=True ):
+    over = len( first_ids ) + len( second_ids ) - budget
+    if over <= 0:
+        return first_ids , second_ids
+    longer = min( over , abs( len( first_ids ) - len( second_ids ) ) )
+    rest = over - longer
+    odd = rest % 2
+    cut_first  = rest // 2 + ( odd if first_loses_odd else 0 ) + ( longer if len( first_ids ) > len( second_ids ) else 0 )
+    cut_second = rest // 2 + ( 0 if first_loses_odd else odd ) + ( longer if len( first_ids ) <= len( second_ids ) else 0 )
+    return first_ids[ : len( first_ids ) - cut_first ] , second_ids[ : len( second_ids ) - cut_second ]
+
+
+# special tokens, truncation and padding for a pair already given as token ids,
+# the same encoding tokenizer( first , second ) gives for the texts they came from
+def encodePair( tokenizer , first_ids , second_ids , max_length , padding=False ):
+    first_ids , second_ids = truncatePair( first_ids , second_ids , max_length - tokenizer.num_special_tokens_to_add( pair=True ) , tokenizer.is_fast )
+    return tokenizer.prepare_for_model(
+        first_ids ,
+        second_ids ,
+        truncation="do_not_truncate" ,
+        max_length=max_length ,
+        padding=padding ,
+    )
+
+
+# token ids of queries already seen by this process, keyed by ( tokenizer , query text )
+# a query comes back in every one of its rows: group_size choices each, hundreds of rows for a test top-1000
+_query_ids = {}
+
+
+def queryIds( tokenizer , queries , max_entries=100000 ):
+    # ids of every query, only the ones not seen before go through the tokenizer, once each
+    if len( _query_ids ) > max_entries:
+        _query_ids.clear()
+    new = list( dict.fromkeys( q for q in queries if ( tokenizer.name_or_path , q ) not in _query_ids ) )
+    if new:
+        for q , ids in zip( new , tokenizer( new , add_special_tokens=False )[ "input_ids" ] ):
+            _query_ids[ ( tokenizer.name_or_path , q ) ] = ids
+    return [ _query_ids[ ( tokenizer.name_or_path , q ) ] for q in queries ]
+
+
+def encodeChoices( tokenizer , token_cache , queries , choices , max_length , padding=False , default=None , repeat_query=True ):
+    # pair every query with each of its choices from cached query and document ids
+    # repeat_query : the second sentence is f"{query} {doc}", the query ids followed by the document ids;
+    #                without it the second sentence is the document alone and more of it fits in max_length
+    # default : ids used for documents missing from the cache, None raises KeyError
+    query_ids = queryIds( tokenizer , queries )
+    tokenized_examples = {}
+    for q_ids , pn_list in zip( query_ids , choices ):
+        encoded = []
+        for doc_name in choiceList( pn_list ):
+            doc_ids = token_cache[ doc_name ] if default is None else token_cache.get( doc_name , default )
+            encoded.append( encodePair( tokenizer , q_ids , q_ids + doc_ids if repeat_query else doc_ids , max_length , padding ) )
+        # one list of choices per row
+        for k in encoded[0].keys():
+            tokenized_examples.setdefault( k , [] ).append( [ x[ k ] for x in encoded ] )
+    return tokenized_examples